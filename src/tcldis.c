@@ -3,11 +3,52 @@
 #include <tclCompile.h>
 #include "tcl_bcutil.c"
 
-static Tcl_Interp *interp;
 static const Tcl_ObjType *tBcType;
 
 #define RUNERR(...) PyErr_Format(PyExc_RuntimeError, ##__VA_ARGS__)
 
+/*
+ * Threading
+ *
+ * A Tcl interpreter may only be used by the thread that created it, so each
+ * thread gets its own. The thread that imports the module uses the interpreter
+ * from libtclpy if it's loaded (so procs created with tclpy can be found) and
+ * any other thread gets a new interpreter the first time it calls in. This
+ * means procs are only visible to the thread that created them. Tcl must be
+ * built with threads enabled.
+ *
+ * Tcl only deletes a thread's interpreter when the thread exits if Tcl created
+ * the thread, which Python threads aren't, so they have to release it
+ * themselves with release_thread_interp.
+ *
+ * The GIL is held while touching Python objects and released while compiling
+ * and disassembling, so threads can extract bytecode in parallel.
+ */
+typedef struct ThreadSpecificData {
+	Tcl_Interp *interp;
+} ThreadSpecificData;
+static Tcl_ThreadDataKey dataKey;
+/* The thread that imported the module, whose interpreter is never deleted */
+static Tcl_ThreadId importThread;
+
+static void
+deleteThreadInterp(ClientData clientData)
+{
+	Tcl_DeleteInterp((Tcl_Interp *)clientData);
+}
+
+static Tcl_Interp *
+getInterp(void)
+{
+	ThreadSpecificData *tsdPtr = (ThreadSpecificData *)
+		Tcl_GetThreadData(&dataKey, sizeof(ThreadSpecificData));
+	if (tsdPtr->interp == NULL) {
+		tsdPtr->interp = Tcl_CreateInterp();
+		Tcl_CreateThreadExitHandler(deleteThreadInterp, tsdPtr->interp);
+	}
+	return tsdPtr->interp;
+}
+
 /* Used for converting types */
 static int
 convSimple(Tcl_Obj *tObj, char** tclString)
@@ -20,9 +61,112 @@ convSimple(Tcl_Obj *tObj, char** tclString)
 static int numTclTypes = 0;
 static const Tcl_ObjType **tclType = NULL;
 static int (**tclTypeConverter) (Tcl_Obj *, char **) = NULL;
+/* Maps a Tcl_ObjType pointer to its index in the arrays above */
+static Tcl_HashTable tclTypeIdxs;
+
+/*
+ * When enabled, dict of every literal and local name string returned so far,
+ * so repeated strings can share one object.
+ */
+static PyObject *internTable = NULL;
+
+/* Steals a reference to pStr and returns the (new reference) shared copy */
+static PyObject *
+internStr(PyObject *pStr)
+{
+	if (pStr == NULL || internTable == NULL)
+		return pStr;
+	PyObject *pInterned = PyDict_GetItem(internTable, pStr);
+	if (pInterned != NULL) {
+		Py_INCREF(pInterned);
+		Py_DECREF(pStr);
+		return pInterned;
+	}
+	if (PyDict_SetItem(internTable, pStr, pStr) != 0) {
+		Py_DECREF(pStr);
+		return NULL;
+	}
+	return pStr;
+}
+
+/* Convert a Tcl literal to a Python unicode string */
+static PyObject *
+literalToPy(Tcl_Obj *tLitObj)
+{
+	char *tclString;
+	int tclStringSize;
+	if (tLitObj->typePtr == NULL) {
+		tclStringSize = convSimple(tLitObj, &tclString);
+	} else {
+		Tcl_HashEntry *entryPtr =
+			Tcl_FindHashEntry(&tclTypeIdxs, (char *)tLitObj->typePtr);
+		if (entryPtr == NULL) {
+			RUNERR("Unknown Tcl type %s", tLitObj->typePtr->name);
+			return NULL;
+		}
+		tclStringSize = (*(tclTypeConverter[(int)(size_t)Tcl_GetHashValue(entryPtr)]))(
+			tLitObj, &tclString);
+	}
+	if (tclStringSize < 0) {
+		RUNERR("Could not convert literal of Tcl type %s",
+			tLitObj->typePtr == NULL ? "(none)" : tLitObj->typePtr->name);
+		return NULL;
+	}
+	return internStr(PyUnicode_DecodeUTF8(tclString, tclStringSize, "strict"));
+}
+
+/*
+ * Whether the body of a proc already holds bytecode which can be used as is.
+ * These are the checks TclProcCompileProc makes before deciding not to
+ * recompile.
+ */
+static int
+procBcIsValid(Tcl_Interp *interp, Proc *procPtr)
+{
+	Tcl_Obj *bodyPtr = procPtr->bodyPtr;
+	if (bodyPtr->typePtr != tBcType)
+		return 0;
+	ByteCode *bc = bodyPtr->internalRep.otherValuePtr;
+	Interp *iPtr = (Interp *)interp;
+	Namespace *nsPtr = procPtr->cmdPtr->nsPtr;
+	return ((Interp *)*bc->interpHandle == iPtr &&
+		bc->compileEpoch == iPtr->compileEpoch &&
+		bc->nsPtr == nsPtr &&
+		bc->nsEpoch == nsPtr->resolverEpoch);
+}
+
+/*
+ * Get the (incref'd) body bytecode object of a proc, compiling it only if the
+ * existing bytecode can't be used. Sets *compiled to whether it was compiled.
+ */
+static Tcl_Obj *
+getProcBcTclObj(Tcl_Interp *interp, Proc *procPtr, const char *tclProcName,
+	int *compiled)
+{
+	int tclRet;
+	*compiled = !procBcIsValid(interp, procPtr);
+	if (*compiled) {
+		Py_BEGIN_ALLOW_THREADS
+		tclRet = TclProcCompileProc(interp, procPtr,
+			procPtr->bodyPtr, procPtr->cmdPtr->nsPtr,
+			"body of proc", tclProcName);
+		Py_END_ALLOW_THREADS
+		if (tclRet != TCL_OK) {
+			RUNERR("proc compilation failed");
+			return NULL;
+		}
+	}
+	Tcl_Obj *tObj = procPtr->bodyPtr;
+	Tcl_IncrRefCount(tObj);
+	return tObj;
+}
 
+/*
+ * Get the (incref'd) bytecode object the arguments refer to. Sets *compiled
+ * to whether bytecode had to be compiled, or -1 if we didn't get to decide.
+ */
 static Tcl_Obj *
-getBcTclObj(PyObject *self, PyObject *args, PyObject *kwargs)
+getBcTclObj(PyObject *self, PyObject *args, PyObject *kwargs, int *compiled)
 {
 	static char *kwlist[] = {"tcl_code", "tclobj_ptr", "proc_name", NULL};
 	char *tclCode = NULL;
@@ -33,8 +177,11 @@ getBcTclObj(PyObject *self, PyObject *args, PyObject *kwargs)
 			&tclCode, &tclObjPtr, &tclProcName))
 		return NULL;
 
+	Tcl_Interp *interp = getInterp();
 	Tcl_Obj *tObj;
+	int tclRet;
 
+	*compiled = -1;
 	if (tclCode != NULL) {
 		tObj = Tcl_NewObj();
 		Tcl_IncrRefCount(tObj);
@@ -43,11 +190,15 @@ getBcTclObj(PyObject *self, PyObject *args, PyObject *kwargs)
 		 * This is unusual - even strings failing parsing return ok (and
 		 * create a bytecode object detailing the error)
 		 */
-		if (Tcl_ConvertToType(interp, tObj, tBcType) != TCL_OK) {
+		Py_BEGIN_ALLOW_THREADS
+		tclRet = Tcl_ConvertToType(interp, tObj, tBcType);
+		Py_END_ALLOW_THREADS
+		if (tclRet != TCL_OK) {
 			Tcl_DecrRefCount(tObj);
 			RUNERR("failed to convert to tcl bytecode");
 			return NULL;
 		}
+		*compiled = 1;
 	} else if (tclObjPtr != 0) {
 		/*
 		 * This is pretty dangerous, we get a raw pointer and just take
@@ -66,16 +217,9 @@ getBcTclObj(PyObject *self, PyObject *args, PyObject *kwargs)
 			RUNERR("could not find tcl proc");
 			return NULL;
 		}
-		/* For simplicity, always compile bytecode */
-		if (TclProcCompileProc(interp, procPtr,
-			procPtr->bodyPtr, procPtr->cmdPtr->nsPtr,
-			"body of proc", tclProcName) != TCL_OK) {
-
-			RUNERR("proc compilation failed");
+		tObj = getProcBcTclObj(interp, procPtr, tclProcName, compiled);
+		if (tObj == NULL)
 			return NULL;
-		}
-		tObj = procPtr->bodyPtr;
-		Tcl_IncrRefCount(tObj);
 	} else {
 		RUNERR("must pass an argument to obtain bytecode from");
 		return NULL;
@@ -87,12 +231,16 @@ getBcTclObj(PyObject *self, PyObject *args, PyObject *kwargs)
 static PyObject *
 tcldis_printbc(PyObject *self, PyObject *args, PyObject *kwargs)
 {
-	Tcl_Obj *tObj = getBcTclObj(self, args, kwargs);
+	int compiled;
+	Tcl_Obj *tObj = getBcTclObj(self, args, kwargs, &compiled);
 	if (tObj == NULL)
 		return NULL;
 
-	Tcl_Obj *tStr = TclDisassembleByteCodeObj(tObj);
+	Tcl_Obj *tStr;
+	Py_BEGIN_ALLOW_THREADS
+	tStr = TclDisassembleByteCodeObj(tObj);
 	Tcl_IncrRefCount(tStr);
+	Py_END_ALLOW_THREADS
 
 	/* If this errors we'll return NULL anyway, don't check explicitly */
 	char *str;
@@ -105,13 +253,163 @@ tcldis_printbc(PyObject *self, PyObject *args, PyObject *kwargs)
 	return pStr;
 }
 
+/*
+ * Read-only buffer over the instructions of a Tcl ByteCode, so they can be
+ * handed to Python without copying. The ByteCode is kept alive by a private
+ * Tcl_Obj holding a reference to it (Tcl frees it as usual once the last
+ * reference goes), so it survives the proc being redefined or the original
+ * object changing type. Indexing gives ints and slicing gives a bytearray
+ * copy, like a bytearray, and it pickles as a bytearray.
+ */
+typedef struct {
+	PyObject_HEAD
+	Tcl_Obj *tHolder;
+	ByteCode *bc;
+	Tcl_ThreadId owner;
+} BytecodeBuffer;
+
+static int bytecodeBuffers = 0;
+
+static void
+BytecodeBuffer_dealloc(BytecodeBuffer *self)
+{
+	/*
+	 * Releasing the ByteCode may touch the interpreter that compiled it, which
+	 * only its own thread may do. Leaking is the lesser evil otherwise.
+	 */
+	if (Tcl_GetCurrentThread() == self->owner)
+		Tcl_DecrRefCount(self->tHolder);
+	self->ob_type->tp_free((PyObject *)self);
+}
+
 static PyObject *
-tcldis_getbc(PyObject *self, PyObject *args, PyObject *kwargs)
+BytecodeBuffer_repr(BytecodeBuffer *self)
 {
-	Tcl_Obj *tObj = getBcTclObj(self, args, kwargs);
-	if (tObj == NULL)
+	return PyString_FromFormat("<BytecodeBuffer of %d bytes>",
+		self->bc->numCodeBytes);
+}
+
+static Py_ssize_t
+BytecodeBuffer_length(BytecodeBuffer *self)
+{
+	return self->bc->numCodeBytes;
+}
+
+static PyObject *
+BytecodeBuffer_item(BytecodeBuffer *self, Py_ssize_t i)
+{
+	if (i < 0 || i >= self->bc->numCodeBytes) {
+		PyErr_SetString(PyExc_IndexError, "BytecodeBuffer index out of range");
 		return NULL;
+	}
+	return PyInt_FromLong(self->bc->codeStart[i]);
+}
+
+static PyObject *
+BytecodeBuffer_slice(BytecodeBuffer *self, Py_ssize_t i, Py_ssize_t j)
+{
+	Py_ssize_t len = self->bc->numCodeBytes;
+	if (i < 0)
+		i = 0;
+	if (j > len)
+		j = len;
+	if (j < i)
+		j = i;
+	return PyByteArray_FromStringAndSize(
+		(char *)self->bc->codeStart + i, j - i);
+}
+
+static Py_ssize_t
+BytecodeBuffer_getreadbuf(BytecodeBuffer *self, Py_ssize_t segment, void **ptr)
+{
+	if (segment != 0) {
+		PyErr_SetString(PyExc_SystemError, "accessing non-existent segment");
+		return -1;
+	}
+	*ptr = self->bc->codeStart;
+	return self->bc->numCodeBytes;
+}
+
+static Py_ssize_t
+BytecodeBuffer_getsegcount(BytecodeBuffer *self, Py_ssize_t *lenp)
+{
+	if (lenp != NULL)
+		*lenp = self->bc->numCodeBytes;
+	return 1;
+}
+
+static int
+BytecodeBuffer_getbuffer(BytecodeBuffer *self, Py_buffer *view, int flags)
+{
+	return PyBuffer_FillInfo(view, (PyObject *)self, self->bc->codeStart,
+		self->bc->numCodeBytes, 1, flags);
+}
+
+static PyObject *
+BytecodeBuffer_reduce(BytecodeBuffer *self)
+{
+	return Py_BuildValue("(O(N))", &PyByteArray_Type,
+		PyString_FromStringAndSize(
+			(char *)self->bc->codeStart, self->bc->numCodeBytes));
+}
+
+static PySequenceMethods BytecodeBuffer_as_sequence = {
+	.sq_length = (lenfunc)BytecodeBuffer_length,
+	.sq_item = (ssizeargfunc)BytecodeBuffer_item,
+	.sq_slice = (ssizessizeargfunc)BytecodeBuffer_slice,
+};
+
+static PyBufferProcs BytecodeBuffer_as_buffer = {
+	.bf_getreadbuffer = (readbufferproc)BytecodeBuffer_getreadbuf,
+	.bf_getsegcount = (segcountproc)BytecodeBuffer_getsegcount,
+	.bf_getcharbuffer = (charbufferproc)BytecodeBuffer_getreadbuf,
+	.bf_getbuffer = (getbufferproc)BytecodeBuffer_getbuffer,
+};
+
+static PyMethodDef BytecodeBuffer_methods[] = {
+	{"__reduce__", (PyCFunction)BytecodeBuffer_reduce, METH_NOARGS, NULL},
+	{NULL, NULL, 0, NULL} /* Sentinel */
+};
 
+static PyTypeObject BytecodeBufferType = {
+	PyObject_HEAD_INIT(NULL)
+	.tp_name = "_tcldis.BytecodeBuffer",
+	.tp_basicsize = sizeof(BytecodeBuffer),
+	.tp_dealloc = (destructor)BytecodeBuffer_dealloc,
+	.tp_repr = (reprfunc)BytecodeBuffer_repr,
+	.tp_as_sequence = &BytecodeBuffer_as_sequence,
+	.tp_as_buffer = &BytecodeBuffer_as_buffer,
+	.tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_NEWBUFFER,
+	.tp_doc = "Read-only buffer over the instructions of Tcl bytecode",
+	.tp_methods = BytecodeBuffer_methods,
+};
+
+static PyObject *
+newBytecodeBuffer(ByteCode *bc)
+{
+	BytecodeBuffer *pBuf = PyObject_New(BytecodeBuffer, &BytecodeBufferType);
+	if (pBuf == NULL)
+		return NULL;
+	Tcl_Obj *tHolder = Tcl_NewObj();
+	Tcl_IncrRefCount(tHolder);
+	/* See bcTclObjToPy for why otherValuePtr */
+	tHolder->internalRep.otherValuePtr = bc;
+	tHolder->typePtr = tBcType;
+	bc->refCount++;
+	pBuf->tHolder = tHolder;
+	pBuf->bc = bc;
+	pBuf->owner = Tcl_GetCurrentThread();
+	return (PyObject *)pBuf;
+}
+
+/*
+ * Build the (bytecode, literals, locals, auxs, compiled) tuple for a bytecode
+ * object, where compiled is as from getBcTclObj (-1 becomes None). The caller
+ * keeps its reference to tObj.
+ */
+static PyObject *
+bcTclObjToPy(Tcl_Obj *tObj, int compiled)
+{
 	/*
 	 * In 8.6 this changed to tObj->internalRep.twoPtrValue.ptr1. In practice,
 	 * this has no effect because of the way the structs are arranged. ptr2 is
@@ -124,40 +422,18 @@ tcldis_getbc(PyObject *self, PyObject *args, PyObject *kwargs)
 	 * Tcl bytecode has an array of literals it references, rather than
 	 * encoding Tcl_Objs directly in the bc. Extract them.
 	 */
-	PyObject *pTclLits = PyList_New(0);
-	PyObject *pTclLit;
 	int numLits = bc->numLitObjects;
-	int tIdx;
-	Tcl_Obj *tLitObj;
-	char *tclString;
-	int tclStringSize;
+	PyObject *pTclLits = PyList_New(numLits);
+	PyObject *pTclLit;
 	if (pTclLits == NULL)
 		numLits = 0;
 	for (i = 0; i < numLits; i++) {
-		tLitObj = bc->objArrayPtr[i];
-		pTclLit = NULL;
-		if (tLitObj->typePtr == NULL) {
-			tclStringSize = convSimple(tLitObj, &tclString);
-			if (tclStringSize > -1)
-				pTclLit = PyString_FromStringAndSize(tclString, tclStringSize);
-		} else {
-			for (tIdx = 0; tIdx < numTclTypes; tIdx++) {
-				if (tLitObj->typePtr != tclType[tIdx])
-					continue;
-				tclStringSize = (*(tclTypeConverter[tIdx]))(tLitObj, &tclString);
-				if (tclStringSize > -1)
-					pTclLit = PyString_FromStringAndSize(tclString, tclStringSize);
-				break;
-			}
-			if (pTclLit == NULL) {
-				RUNERR("Unknown Tcl type %s", tLitObj->typePtr->name);
-			}
-		}
-		if (pTclLit == NULL || PyList_Append(pTclLits, pTclLit) != 0) {
-			Py_CLEAR(pTclLit);
+		pTclLit = literalToPy(bc->objArrayPtr[i]);
+		if (pTclLit == NULL) {
 			Py_CLEAR(pTclLits);
 			break;
 		}
+		PyList_SET_ITEM(pTclLits, i, pTclLit);
 	}
 
 	/*
@@ -176,7 +452,8 @@ tcldis_getbc(PyObject *self, PyObject *args, PyObject *kwargs)
 	if (pTclLocals == NULL)
 		numLocals = 0;
 	for (i = 0; i < numLocals; i++) {
-		pTclLocal = PyString_FromStringAndSize(tclLocal->name, tclLocal->nameLength);
+		pTclLocal = internStr(PyUnicode_DecodeUTF8(
+			tclLocal->name, tclLocal->nameLength, "strict"));
 		if (pTclLocal == NULL || PyList_Append(pTclLocals, pTclLocal) != 0) {
 			Py_CLEAR(pTclLocal);
 			Py_CLEAR(pTclLocals);
@@ -260,14 +537,13 @@ tcldis_getbc(PyObject *self, PyObject *args, PyObject *kwargs)
 
 	/*
 	 * Tcl bytecode has an array of bytes representing the actual
-	 * instructions and operands. Put the bytes in a bytearray.
+	 * instructions and operands. Put the bytes in a bytearray, or share
+	 * them if asked.
 	 */
 	/* If this errors we'll return NULL anyway, don't check explicitly */
 	/* The cast is fine because Python treats bytearrays as unsigned */
-	PyObject *pBuf = PyByteArray_FromStringAndSize(
-		(char *)bc->codeStart, bc->numCodeBytes);
-
-	Tcl_DecrRefCount(tObj);
+	PyObject *pBuf = bytecodeBuffers ? newBytecodeBuffer(bc) :
+		PyByteArray_FromStringAndSize((char *)bc->codeStart, bc->numCodeBytes);
 
 	if (pTclLits == NULL || pTclLocals == NULL || pTclAuxs == NULL || pBuf == NULL) {
 		Py_CLEAR(pTclLits);
@@ -276,7 +552,199 @@ tcldis_getbc(PyObject *self, PyObject *args, PyObject *kwargs)
 		Py_CLEAR(pBuf);
 		return NULL;
 	}
-	return Py_BuildValue("NNNN", pBuf, pTclLits, pTclLocals, pTclAuxs);
+	PyObject *pCompiled = compiled == -1 ? Py_None : PyBool_FromLong(compiled);
+	if (compiled == -1)
+		Py_INCREF(Py_None);
+	return Py_BuildValue("NNNNN", pBuf, pTclLits, pTclLocals, pTclAuxs, pCompiled);
+}
+
+static PyObject *
+tcldis_getbc(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+	int compiled;
+	Tcl_Obj *tObj = getBcTclObj(self, args, kwargs, &compiled);
+	if (tObj == NULL)
+		return NULL;
+
+	PyObject *pBc = bcTclObjToPy(tObj, compiled);
+	Tcl_DecrRefCount(tObj);
+	return pBc;
+}
+
+static PyObject *
+tcldis_getbc_many(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+	static char *kwlist[] = {"proc_names", NULL};
+	PyObject *pProcNames = NULL;
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O", kwlist, &pProcNames))
+		return NULL;
+
+	pProcNames = PySequence_Fast(pProcNames, "proc_names must be a sequence");
+	if (pProcNames == NULL)
+		return NULL;
+
+	Tcl_Interp *interp = getInterp();
+	Py_ssize_t numProcs = PySequence_Fast_GET_SIZE(pProcNames);
+	PyObject *pBcs = PyList_New(numProcs);
+	Py_ssize_t i;
+	PyObject *pProcName;
+	char *tclProcName;
+	Proc *procPtr;
+	Tcl_Obj *tObj;
+	PyObject *pBc;
+	int compiled;
+	for (i = 0; pBcs != NULL && i < numProcs; i++) {
+		/* Tcl names are UTF-8, PyString_AsString would only take ASCII */
+		pProcName = PySequence_Fast_GET_ITEM(pProcNames, i);
+		if (PyUnicode_Check(pProcName)) {
+			pProcName = PyUnicode_AsUTF8String(pProcName);
+		} else {
+			Py_INCREF(pProcName);
+		}
+		pBc = NULL;
+		tclProcName = pProcName == NULL ? NULL : PyString_AsString(pProcName);
+		if (tclProcName == NULL)
+			goto next;
+		procPtr = TclFindProc((Interp *)interp, tclProcName);
+		if (procPtr == NULL) {
+			RUNERR("could not find tcl proc %s", tclProcName);
+			goto next;
+		}
+		tObj = getProcBcTclObj(interp, procPtr, tclProcName, &compiled);
+		if (tObj == NULL)
+			goto next;
+		pBc = bcTclObjToPy(tObj, compiled);
+		Tcl_DecrRefCount(tObj);
+next:
+		Py_XDECREF(pProcName);
+		if (pBc == NULL) {
+			Py_CLEAR(pBcs);
+			break;
+		}
+		PyList_SET_ITEM(pBcs, i, pBc);
+	}
+
+	Py_DECREF(pProcNames);
+	return pBcs;
+}
+
+/*
+ * Whether names starting with name could match a pattern whose first
+ * prefixLen characters are plain, i.e. mean nothing special to
+ * Tcl_StringMatch.
+ */
+static int
+couldMatch(const char *name, const char *pattern, size_t prefixLen)
+{
+	size_t len = strlen(name);
+	return strncmp(name, pattern, len < prefixLen ? len : prefixLen) == 0;
+}
+
+/*
+ * Add the bytecode of every proc in a namespace to pBcs, keyed by fully
+ * qualified name, and then of every child namespace if recursive. If pattern
+ * isn't NULL, only procs whose fully qualified name matches it (as for Tcl's
+ * string match) are included - the rest aren't compiled and child namespaces
+ * that can't contain a match aren't searched.
+ */
+static int
+addNamespaceBcs(Tcl_Interp *interp, Namespace *nsPtr, PyObject *pBcs,
+	int recursive, const char *pattern, size_t prefixLen)
+{
+	Tcl_HashSearch search;
+	Tcl_HashEntry *entryPtr;
+	Namespace *childPtr;
+	Command *cmdPtr;
+	Proc *procPtr;
+	Tcl_Obj *tNameObj, *tObj;
+	PyObject *pBc;
+	int compiled;
+	int ret = 0;
+
+	tNameObj = Tcl_NewObj();
+	Tcl_IncrRefCount(tNameObj);
+	for (entryPtr = Tcl_FirstHashEntry(&nsPtr->cmdTable, &search);
+			entryPtr != NULL; entryPtr = Tcl_NextHashEntry(&search)) {
+		cmdPtr = (Command *)Tcl_GetHashValue(entryPtr);
+		/* Imported procs aren't procs here, they belong to their origin */
+		procPtr = TclIsProc(cmdPtr);
+		if (procPtr == NULL)
+			continue;
+
+		Tcl_SetObjLength(tNameObj, 0);
+		Tcl_GetCommandFullName(interp, (Tcl_Command)cmdPtr, tNameObj);
+		if (pattern != NULL &&
+				!Tcl_StringMatch(Tcl_GetString(tNameObj), pattern))
+			continue;
+		tObj = getProcBcTclObj(interp, procPtr, Tcl_GetString(tNameObj),
+			&compiled);
+		if (tObj == NULL) {
+			ret = -1;
+			break;
+		}
+		pBc = bcTclObjToPy(tObj, compiled);
+		Tcl_DecrRefCount(tObj);
+		if (pBc == NULL ||
+				PyDict_SetItemString(pBcs, Tcl_GetString(tNameObj), pBc) != 0) {
+			Py_XDECREF(pBc);
+			ret = -1;
+			break;
+		}
+		Py_DECREF(pBc);
+	}
+	Tcl_DecrRefCount(tNameObj);
+
+	if (ret != 0 || !recursive)
+		return ret;
+
+	for (entryPtr = Tcl_FirstHashEntry(&nsPtr->childTable, &search);
+			entryPtr != NULL; entryPtr = Tcl_NextHashEntry(&search)) {
+		childPtr = (Namespace *)Tcl_GetHashValue(entryPtr);
+		if (pattern != NULL &&
+				!couldMatch(childPtr->fullName, pattern, prefixLen))
+			continue;
+		if (addNamespaceBcs(interp, childPtr, pBcs, recursive, pattern,
+				prefixLen) != 0)
+			return -1;
+	}
+	return 0;
+}
+
+static PyObject *
+tcldis_getbc_namespace(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+	static char *kwlist[] = {"ns", "recursive", "pattern", NULL};
+	char *tclNsName = "::";
+	PyObject *pRecursive = Py_True;
+	char *pattern = NULL;
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|sOz", kwlist,
+			&tclNsName, &pRecursive, &pattern))
+		return NULL;
+
+	int recursive = PyObject_IsTrue(pRecursive);
+	if (recursive == -1)
+		return NULL;
+
+	Tcl_Interp *interp = getInterp();
+	Tcl_Namespace *nsPtr = Tcl_FindNamespace(interp, tclNsName, NULL, 0);
+	if (nsPtr == NULL) {
+		RUNERR("could not find tcl namespace %s", tclNsName);
+		return NULL;
+	}
+
+	PyObject *pBcs = PyDict_New();
+	if (pBcs == NULL)
+		return NULL;
+	/* Up to the first character special to Tcl_StringMatch */
+	size_t prefixLen = pattern == NULL ? 0 : strcspn(pattern, "*?[\\");
+	if (addNamespaceBcs(interp, (Namespace *)nsPtr, pBcs, recursive, pattern,
+			prefixLen) != 0) {
+		Py_DECREF(pBcs);
+		return NULL;
+	}
+	return pBcs;
 }
 
 static PyObject *
@@ -368,6 +836,172 @@ err:
 	return NULL;
 }
 
+/*
+ * Decode a stream of instructions into packed arrays - the columns of an
+ * InstStream - and find where basic blocks start. Operands are decoded but
+ * not resolved, unused operand slots are 0 and non-jumps have a target of -1.
+ * Block starts are instruction indexes, found by the same rules as
+ * _bblock_create: the first instruction, jump targets, the instruction after a
+ * jump, and beginCatch4/endCatch.
+ */
+static PyObject *
+tcldis_decode(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+	static char *kwlist[] = {"bytecode", "pc", NULL};
+	Py_buffer code;
+	Py_ssize_t startPc = 0;
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwargs, "s*|n", kwlist,
+			&code, &startPc))
+		return NULL;
+
+	const InstructionDesc *insts =
+		(const InstructionDesc *)TclGetInstructionTable();
+	int numInstTypes, numSlots = 0;
+	for (numInstTypes = 0; insts[numInstTypes].name != NULL; numInstTypes++) {
+		if (insts[numInstTypes].numOperands > numSlots)
+			numSlots = insts[numInstTypes].numOperands;
+	}
+
+	const unsigned char *codeStart = code.buf;
+	Py_ssize_t codeLen = code.len;
+	/* Every instruction is at least one byte, so this many is plenty */
+	Py_ssize_t maxInsts = codeLen - startPc > 0 ? codeLen - startPc : 0;
+	long *locs = PyMem_New(long, maxInsts + 1);
+	unsigned char *opcodes = PyMem_New(unsigned char, maxInsts + 1);
+	long *ops = PyMem_New(long, numSlots * maxInsts + 1);
+	long *targetLocs = PyMem_New(long, maxInsts + 1);
+	Py_ssize_t *locIdxs = PyMem_New(Py_ssize_t, codeLen + 1);
+	char *isStart = PyMem_New(char, maxInsts + 1);
+	long *starts = PyMem_New(long, maxInsts + 1);
+	PyObject *pRet = NULL;
+
+	if (locs == NULL || opcodes == NULL || ops == NULL || targetLocs == NULL ||
+			locIdxs == NULL || isStart == NULL || starts == NULL) {
+		PyErr_NoMemory();
+		goto done;
+	}
+
+	Py_ssize_t pc, i, numInsts = 0, numStarts = 0;
+	int slot;
+	long op, targetLoc;
+	const InstructionDesc *desc;
+	const unsigned char *opPtr;
+	for (pc = 0; pc < codeLen; pc++)
+		locIdxs[pc] = -1;
+	memset(isStart, 0, maxInsts + 1);
+
+	for (pc = startPc; pc < codeLen; pc += desc->numBytes) {
+		if (codeStart[pc] >= numInstTypes) {
+			RUNERR("unknown opcode %d at %zd", codeStart[pc], pc);
+			goto done;
+		}
+		desc = &insts[codeStart[pc]];
+		if (pc + desc->numBytes > codeLen) {
+			RUNERR("instruction at %zd runs past the end of the bytecode", pc);
+			goto done;
+		}
+		locs[numInsts] = pc;
+		opcodes[numInsts] = codeStart[pc];
+		locIdxs[pc] = numInsts;
+		opPtr = codeStart + pc + 1;
+		for (slot = 0; slot < numSlots; slot++) {
+			op = 0;
+			if (slot < desc->numOperands) {
+				switch (desc->opTypes[slot]) {
+				case OPERAND_INT1:
+					op = TclGetInt1AtPtr(opPtr); opPtr += 1; break;
+				case OPERAND_UINT1: case OPERAND_LVT1:
+					op = TclGetUInt1AtPtr(opPtr); opPtr += 1; break;
+				case OPERAND_INT4: case OPERAND_IDX4:
+					op = TclGetInt4AtPtr(opPtr); opPtr += 4; break;
+				case OPERAND_UINT4: case OPERAND_LVT4: case OPERAND_AUX4:
+					op = TclGetUInt4AtPtr(opPtr); opPtr += 4; break;
+#if TCL_MAJOR_VERSION > 8 || TCL_MINOR_VERSION >= 6
+				/* 8.6 gives some operands their own types, same encoding */
+				case OPERAND_OFFSET1:
+					op = TclGetInt1AtPtr(opPtr); opPtr += 1; break;
+				case OPERAND_OFFSET4:
+					op = TclGetInt4AtPtr(opPtr); opPtr += 4; break;
+				case OPERAND_LIT1: case OPERAND_SCLS1:
+					op = TclGetUInt1AtPtr(opPtr); opPtr += 1; break;
+				case OPERAND_LIT4:
+					op = TclGetUInt4AtPtr(opPtr); opPtr += 4; break;
+#endif
+				default:
+					RUNERR("can't decode operand of %s at %zd",
+						desc->name, pc);
+					goto done;
+				}
+			}
+			ops[slot * maxInsts + numInsts] = op;
+		}
+		switch (codeStart[pc]) {
+		case INST_JUMP1: case INST_JUMP4:
+		case INST_JUMP_TRUE1: case INST_JUMP_TRUE4:
+		case INST_JUMP_FALSE1: case INST_JUMP_FALSE4:
+			targetLocs[numInsts] = pc + ops[numInsts];
+			break;
+		default:
+			targetLocs[numInsts] = -1;
+		}
+		numInsts++;
+	}
+
+	if (numInsts > 0)
+		isStart[0] = 1;
+	for (i = 0; i < numInsts; i++) {
+		targetLoc = targetLocs[i];
+		if (targetLoc != -1) {
+			if (targetLoc < startPc || targetLoc >= codeLen ||
+					locIdxs[targetLoc] == -1) {
+				RUNERR("jump at %ld to %ld, which isn't an instruction",
+					locs[i], targetLoc);
+				goto done;
+			}
+			isStart[locIdxs[targetLoc]] = 1;
+			isStart[i + 1] = 1;
+		} else if (opcodes[i] == INST_BEGIN_CATCH4 ||
+				opcodes[i] == INST_END_CATCH) {
+			isStart[i] = 1;
+		}
+	}
+	for (i = 0; i < numInsts; i++) {
+		if (isStart[i])
+			starts[numStarts++] = i;
+	}
+
+	PyObject *pOps = PyList_New(numSlots);
+	if (pOps == NULL)
+		goto done;
+	for (slot = 0; slot < numSlots; slot++) {
+		PyObject *pSlot = PyString_FromStringAndSize(
+			(char *)(ops + slot * maxInsts), numInsts * sizeof(long));
+		if (pSlot == NULL) {
+			Py_DECREF(pOps);
+			goto done;
+		}
+		PyList_SET_ITEM(pOps, slot, pSlot);
+	}
+	pRet = Py_BuildValue("(s#s#Ns#s#)",
+		(char *)locs, (int)(numInsts * sizeof(long)),
+		(char *)opcodes, (int)numInsts,
+		pOps,
+		(char *)targetLocs, (int)(numInsts * sizeof(long)),
+		(char *)starts, (int)(numStarts * sizeof(long)));
+
+done:
+	PyMem_Free(locs);
+	PyMem_Free(opcodes);
+	PyMem_Free(ops);
+	PyMem_Free(targetLocs);
+	PyMem_Free(locIdxs);
+	PyMem_Free(isStart);
+	PyMem_Free(starts);
+	PyBuffer_Release(&code);
+	return pRet;
+}
+
 static PyObject *
 tcldis_literal_convert(PyObject *self, PyObject *args, PyObject *kwargs)
 {
@@ -421,6 +1055,68 @@ tcldis_literal_convert(PyObject *self, PyObject *args, PyObject *kwargs)
 	return Py_BuildValue("O", Py_None);
 }
 
+static PyObject *
+tcldis_literal_intern(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+	static char *kwlist[] = {"enable", NULL};
+	PyObject *pEnable = Py_True;
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|O", kwlist, &pEnable))
+		return NULL;
+
+	int enable = PyObject_IsTrue(pEnable);
+	if (enable == -1)
+		return NULL;
+
+	if (!enable) {
+		Py_CLEAR(internTable);
+	} else if (internTable == NULL) {
+		internTable = PyDict_New();
+		if (internTable == NULL)
+			return NULL;
+	}
+
+	return Py_BuildValue("O", Py_None);
+}
+
+static PyObject *
+tcldis_bytecode_buffer(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+	static char *kwlist[] = {"enable", NULL};
+	PyObject *pEnable = Py_True;
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|O", kwlist, &pEnable))
+		return NULL;
+
+	int enable = PyObject_IsTrue(pEnable);
+	if (enable == -1)
+		return NULL;
+	bytecodeBuffers = enable;
+
+	return Py_BuildValue("O", Py_None);
+}
+
+static PyObject *
+tcldis_release_thread_interp(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+	static char *kwlist[] = {NULL};
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwargs, "", kwlist))
+		return NULL;
+
+	if (Tcl_GetCurrentThread() == importThread)
+		return Py_BuildValue("O", Py_None);
+	ThreadSpecificData *tsdPtr = (ThreadSpecificData *)
+		Tcl_GetThreadData(&dataKey, sizeof(ThreadSpecificData));
+	if (tsdPtr->interp != NULL) {
+		Tcl_DeleteThreadExitHandler(deleteThreadInterp, tsdPtr->interp);
+		Tcl_DeleteInterp(tsdPtr->interp);
+		tsdPtr->interp = NULL;
+	}
+
+	return Py_BuildValue("O", Py_None);
+}
+
 static PyMethodDef TclDisMethods[] = {
 	{"printbc",  (PyCFunction)tcldis_printbc,
 		METH_VARARGS | METH_KEYWORDS,
@@ -428,12 +1124,30 @@ static PyMethodDef TclDisMethods[] = {
 	{"getbc",  (PyCFunction)tcldis_getbc,
 		METH_VARARGS | METH_KEYWORDS,
 		"Given some Tcl code, get the bytecode as a bytearray."},
+	{"getbc_many",  (PyCFunction)tcldis_getbc_many,
+		METH_VARARGS | METH_KEYWORDS,
+		"Given a sequence of proc names, get the bytecode of each as getbc."},
+	{"getbc_namespace",  (PyCFunction)tcldis_getbc_namespace,
+		METH_VARARGS | METH_KEYWORDS,
+		"Get the bytecode of all procs in a namespace (matching a pattern) as a dict by name."},
 	{"inst_table",  (PyCFunction)tcldis_inst_table,
 		METH_VARARGS | METH_KEYWORDS,
 		"Get the instruction table for Tcl bytecode."},
+	{"decode",  (PyCFunction)tcldis_decode,
+		METH_VARARGS | METH_KEYWORDS,
+		"Decode bytecode into packed instruction arrays and block starts."},
 	{"literal_convert",  (PyCFunction)tcldis_literal_convert,
 		METH_VARARGS | METH_KEYWORDS,
 		"Set the converter for a type of literal value."},
+	{"literal_intern",  (PyCFunction)tcldis_literal_intern,
+		METH_VARARGS | METH_KEYWORDS,
+		"Enable or disable sharing of repeated literal and local strings."},
+	{"bytecode_buffer",  (PyCFunction)tcldis_bytecode_buffer,
+		METH_VARARGS | METH_KEYWORDS,
+		"Enable or disable returning bytecode as a zero-copy BytecodeBuffer."},
+	{"release_thread_interp",  (PyCFunction)tcldis_release_thread_interp,
+		METH_VARARGS | METH_KEYWORDS,
+		"Delete the Tcl interpreter of the calling thread, if it has its own."},
 	{NULL, NULL, 0, NULL} /* Sentinel */
 };
 
@@ -441,11 +1155,16 @@ static PyMethodDef TclDisMethods[] = {
 PyMODINIT_FUNC
 init_tcldis(void)
 {
-	interp = PyCapsule_Import("tclpy.interp", 0);
+	Tcl_Interp *interp = PyCapsule_Import("tclpy.interp", 0);
 	if (interp == NULL) {
 		PyErr_Clear();
 		interp = Tcl_CreateInterp();
 	}
+	/* Only now is Tcl sure to be initialised */
+	ThreadSpecificData *tsdPtr = (ThreadSpecificData *)
+		Tcl_GetThreadData(&dataKey, sizeof(ThreadSpecificData));
+	tsdPtr->interp = interp;
+	importThread = Tcl_GetCurrentThread();
 
 	tBcType = Tcl_GetObjType("bytecode");
 
@@ -460,19 +1179,33 @@ init_tcldis(void)
 
 	tclType = malloc(numTclTypes*sizeof(*tclType));
 	tclTypeConverter = malloc(numTclTypes*sizeof(*tclTypeConverter));
-	int i;
+	Tcl_InitHashTable(&tclTypeIdxs, TCL_ONE_WORD_KEYS);
+	int i, isNew;
 	Tcl_Obj *tType;
 	for (i = 0; i < numTclTypes; i++) {
 		Tcl_ListObjIndex(interp, tTypes, i, &tType);
 		tclType[i] = Tcl_GetObjType(Tcl_GetString(tType));
 		tclTypeConverter[i] = convSimple;
+		Tcl_SetHashValue(
+			Tcl_CreateHashEntry(&tclTypeIdxs, (char *)tclType[i], &isNew),
+			(ClientData)(size_t)i);
 	}
 
 	Tcl_DecrRefCount(tTypes);
 
+	if (PyType_Ready(&BytecodeBufferType) < 0)
+		return;
+
 	PyObject *m = Py_InitModule("_tcldis", TclDisMethods);
 	if (m == NULL)
 		return;
+	PyObject *pBufType = (PyObject *)&BytecodeBufferType;
+	Py_INCREF(pBufType);
+	if (PyModule_AddObject(m, "BytecodeBuffer", pBufType) != 0)
+		return;
+	/* The Tcl this was built against - bytecode is specific to it */
+	if (PyModule_AddStringConstant(m, "TCL_PATCH_LEVEL", TCL_PATCH_LEVEL) != 0)
+		return;
 }
 
 
@@ -1,11 +1,33 @@
 from __future__ import print_function
 
+import array
+import bisect
+import os
+import re
+import sys
+import mmap
+import time
 import struct
+import sqlite3
+import threading
+import binascii
+import hashlib
+import argparse
 import itertools
-from collections import namedtuple, OrderedDict
-
-import _tcldis
-printbc = _tcldis.printbc
+import multiprocessing
+import cPickle as pickle
+from collections import namedtuple, Counter, OrderedDict
+
+try:
+    import _tcldis
+except ImportError:
+    # Without the extension (e.g. on a machine without Tcl) bytecode can't be
+    # extracted, but bytecode saved with BC.dump can still be loaded and
+    # decompiled
+    _tcldis = None
+__version__ = '0.1'
+# The Tcl the bytecode is from - without _tcldis, from the first BC.load
+TCL_PATCH_LEVEL = _tcldis.TCL_PATCH_LEVEL if _tcldis is not None else None
 def getbc(*args, **kwargs):
     """
     Accepts a keyword argument of:
@@ -16,14 +38,40 @@ def getbc(*args, **kwargs):
        created by libtclpy
     Returns a `BC` object containing information about the bytecode.
     """
-    bytecode, bcliterals, bclocals, bcauxs = _tcldis.getbc(*args, **kwargs)
-    bcliterals = [bclit.decode('utf-8') for bclit in bcliterals]
-    bclocals =   [bcloc.decode('utf-8') for bcloc in bclocals]
-    return BC(bytecode, bcliterals, bclocals, bcauxs)
-getbc.__doc__ = _tcldis.getbc.__doc__
-literal_convert = _tcldis.literal_convert
-
-INSTRUCTIONS = _tcldis.inst_table()
+    return _bctuple_to_bc(_tcldis.getbc(*args, **kwargs))
+def getbc_many(proc_names):
+    """
+    Given a sequence of names of procs in the interpreter, returns a list of
+    `BC` objects for them in the same order. Equivalent to calling `getbc`
+    with each `proc_name`, but all extracted in one go.
+    """
+    return [_bctuple_to_bc(bctuple) for bctuple in _tcldis.getbc_many(proc_names)]
+def getbc_namespace(ns='::', recursive=True, pattern=None):
+    """
+    Returns a dict of fully qualified proc name to `BC` object for every proc
+    in the namespace `ns` and, if `recursive`, all of its child namespaces.
+    If `pattern` is given, only procs whose fully qualified name matches it (as
+    for Tcl's `string match`) are included, and no others are compiled.
+    """
+    if type(pattern) is unicode:
+        pattern = pattern.encode('utf-8')
+    bctuples = _tcldis.getbc_namespace(ns, recursive, pattern)
+    return dict([
+        (name, _bctuple_to_bc(bctuple)) for name, bctuple in bctuples.iteritems()
+    ])
+def _bctuple_to_bc(bctuple):
+    return BC(*bctuple)
+if _tcldis is not None:
+    printbc = _tcldis.printbc
+    getbc.__doc__ = _tcldis.getbc.__doc__
+    literal_convert = _tcldis.literal_convert
+    literal_intern = _tcldis.literal_intern
+    bytecode_buffer = _tcldis.bytecode_buffer
+    release_thread_interp = _tcldis.release_thread_interp
+
+# The instruction table of the Tcl the bytecode is from - without _tcldis, from
+# the first BC.load
+INSTRUCTIONS = _tcldis.inst_table() if _tcldis is not None else None
 JUMP_INSTRUCTIONS = [
     'jump1', 'jump4', 'jumpTrue1', 'jumpTrue4', 'jumpFalse1', 'jumpFalse4'
 ]
@@ -35,40 +83,164 @@ TAG_CATCH      = 'catch'
 TAG_IF         = 'if'
 TAG_I_PUSH     = 'i_push'
 TAG_I_OTHER    = 'i_other'
+TAG_I_STACK    = 'i_stack'
 TAG_H_VARIABLE = 'h_variable'
 
-def _getop(optype):
-    """
-    Given a C struct descriptor, return a function which will take the necessary
-    bytes off the front of a bytearray and return the python value.
-    """
-    def getop_lambda(bc):
-        # The 'standard' sizes in the struct module match up to what Tcl expects
-        numbytes = struct.calcsize(optype)
-        opbytes = ''.join([chr(bc.pop(0)) for _ in range(numbytes)])
-        return struct.unpack(optype, opbytes)[0]
-    return getop_lambda
+OPKIND_IMM   = 'imm'
+OPKIND_LOCAL = 'local'
+OPKIND_AUX   = 'aux'
 
-# InstOperandType from tclCompile.h
+# InstOperandType from tclCompile.h, with the struct format and the kind of
+# value each decodes to. The 'standard' sizes in the struct module match up to
+# what Tcl expects. Note that literal indexes are plain unsigned ints in 8.5 -
+# they are resolved against the literal table when reducing, not decoding.
 OPERANDS = [
-    ('NONE',  None), # Should never be present
-    ('INT1',  _getop('>b')),
-    ('INT4',  _getop('>i')),
-    ('UINT1', _getop('>B')),
-    ('UINT4', _getop('>I')),
-    ('IDX4',  _getop('>i')),
-    ('LVT1',  _getop('>B')),
-    ('LVT4',  _getop('>I')),
-    ('AUX4',  _getop('>I')),
+    ('NONE',  '',  None), # Should never be present
+    ('INT1',  'b', OPKIND_IMM),
+    ('INT4',  'i', OPKIND_IMM),
+    ('UINT1', 'B', OPKIND_IMM),
+    ('UINT4', 'I', OPKIND_IMM),
+    ('IDX4',  'i', None), # Unsupported
+    ('LVT1',  'B', OPKIND_LOCAL),
+    ('LVT4',  'I', OPKIND_LOCAL),
+    ('AUX4',  'I', OPKIND_AUX),
 ]
 
+InstDecoder = namedtuple('InstDecoder', [
+    'name', 'num_bytes', 'opstruct', 'opkinds', 'resolve', 'jump'
+])
+def _inst_decoders():
+    """
+    Precompute how to decode each opcode in the instruction table. All operands
+    of an instruction are fused into a single struct so decoding is one unpack.
+    """
+    inst_decoders = []
+    for inst_type in INSTRUCTIONS:
+        opfmt = '>'
+        opkinds = []
+        for opnum in inst_type['operands']:
+            # Operand types from newer versions of Tcl can't be decoded
+            if opnum >= len(OPERANDS):
+                opfmt = None
+                break
+            _, fmtchar, opkind = OPERANDS[opnum]
+            opfmt += fmtchar
+            opkinds.append(opkind)
+        inst_decoders.append(InstDecoder(
+            name=inst_type['name'],
+            num_bytes=inst_type['num_bytes'],
+            opstruct=struct.Struct(opfmt) if opfmt is not None else None,
+            opkinds=tuple(opkinds),
+            resolve=any([opkind != OPKIND_IMM for opkind in opkinds]),
+            jump=inst_type['name'] in JUMP_INSTRUCTIONS,
+        ))
+    return inst_decoders
+
+INST_DECODERS = _inst_decoders() if INSTRUCTIONS is not None else None
+
+def _set_instructions(instructions, patchlevel):
+    global INSTRUCTIONS, INST_DECODERS, TCL_PATCH_LEVEL
+    INSTRUCTIONS = instructions
+    INST_DECODERS = _inst_decoders()
+    TCL_PATCH_LEVEL = patchlevel
+
+# Format of BC.dump. After the magic, all integers are little endian and all
+# strings are length prefixed UTF-8. The format version comes first, followed
+# by:
+#  - the Tcl patch level and instruction table, as a count followed by the
+#    name, num_bytes, stack_effect (INT_MIN for 'op1') and operands of each
+#  - the bytecode, literals, locals and auxs, each preceded by their length
+#  - the pc and whether the bytecode was compiled (2 for None)
+# Auxs are their type followed by a count of lists of local indexes (or
+# 0xffffffff for no data) and the lists.
+_BC_MAGIC = 'TCLDISBC'
+_BC_FORMAT_VERSION = 1
+_BC_U32 = struct.Struct('<I')
+_BC_INST = struct.Struct('<BiB')
+_BC_STACK_OP1 = -2**31
+_BC_NO_AUXDATA = 0xffffffff
+_BC_COMPILED = {False: 0, True: 1, None: 2}
+_BC_COMPILED_VALUES = dict([(v, k) for k, v in _BC_COMPILED.items()])
+def _load_compiled(n):
+    try:
+        return _BC_COMPILED_VALUES[n]
+    except KeyError:
+        raise ValueError('bad compiled flag %s in BC dump' % (n,))
+
+def _dump_u32(chunks, n):
+    chunks.append(_BC_U32.pack(n))
+
+def _dump_str(chunks, s):
+    if type(s) is unicode:
+        s = s.encode('utf-8')
+    _dump_u32(chunks, len(s))
+    chunks.append(s)
+
+def _load_exact(fileobj, n):
+    data = fileobj.read(n)
+    if len(data) != n:
+        raise ValueError('truncated BC dump')
+    return data
+
+def _load_u32(fileobj):
+    return _BC_U32.unpack(_load_exact(fileobj, _BC_U32.size))[0]
+
+def _load_str(fileobj):
+    return _load_exact(fileobj, _load_u32(fileobj))
+
+def _dump_instructions(chunks):
+    _dump_str(chunks, TCL_PATCH_LEVEL)
+    _dump_u32(chunks, len(INSTRUCTIONS))
+    for inst_type in INSTRUCTIONS:
+        _dump_str(chunks, inst_type['name'])
+        stack_effect = inst_type['stack_effect']
+        chunks.append(_BC_INST.pack(
+            inst_type['num_bytes'],
+            _BC_STACK_OP1 if stack_effect == 'op1' else stack_effect,
+            len(inst_type['operands']),
+        ))
+        chunks.append(''.join([chr(opnum) for opnum in inst_type['operands']]))
+
+def _load_instructions(fileobj):
+    """
+    Read an instruction table written by `_dump_instructions`, making it the
+    one in use if there isn't one yet and otherwise checking it matches.
+    """
+    patchlevel = _load_str(fileobj)
+    instructions = []
+    for _ in xrange(_load_u32(fileobj)):
+        name = _load_str(fileobj)
+        num_bytes, stack_effect, numops = _BC_INST.unpack(
+            _load_exact(fileobj, _BC_INST.size)
+        )
+        instructions.append({
+            'name': name,
+            'num_bytes': num_bytes,
+            'stack_effect': 'op1' if stack_effect == _BC_STACK_OP1 else stack_effect,
+            'operands': [ord(c) for c in _load_exact(fileobj, numops)],
+        })
+    if INSTRUCTIONS is None:
+        _set_instructions(instructions, patchlevel)
+    elif instructions != INSTRUCTIONS:
+        raise ValueError(
+            'bytecode is from Tcl %s, which has a different instruction '
+            'table' % (patchlevel,)
+        )
+
 class BC(object):
-    def __init__(self, bytecode, bcliterals, bclocals, bcauxs):
+    def __init__(self, bytecode, bcliterals, bclocals, bcauxs, compiled=None):
         self._bytecode = bytecode
         self._literals = bcliterals
         self._locals = bclocals
         self._auxs = bcauxs
         self._pc = 0
+        # Whether getbc had to compile this (False if it reused bytecode a
+        # proc already had), or None if unknown
+        self.compiled = compiled
+        # Read-only window onto the instructions, so operands can be decoded
+        # in place rather than sliced out
+        self._view = memoryview(bytecode)
+        self._digest = None
     def __repr__(self):
         return 'BC(%s,%s,%s,%s,%s)' % tuple([repr(v) for v in [
             self._bytecode,
@@ -101,56 +273,162 @@ class BC(object):
         return self._bytecode[self._pc]
     def pc(self):
         return self._pc
+    def view(self):
+        return self._view
     def get(self, n):
         oldpc = self._pc
         self._pc += n
         return self._bytecode[oldpc:self._pc]
+    def skip(self, n):
+        self._pc += n
     def copy(self):
-        bc = BC(self._bytecode, self._literals, self._locals, self._auxs)
-        bc.get(self._pc)
+        bc = BC(
+            self._bytecode, self._literals, self._locals, self._auxs,
+            self.compiled
+        )
+        bc.skip(self._pc)
         return bc
+    def __reduce__(self):
+        # The memoryview can't be pickled, it's recreated on construction
+        return (
+            BC, (self._bytecode, self._literals, self._locals, self._auxs),
+            {'_pc': self._pc, 'compiled': self.compiled}
+        )
+    def dump(self, fileobj):
+        """
+        Write this bytecode to a binary file object in a compact format, with
+        the instruction table needed to decode it. It can be read back with
+        `BC.load`, including where Tcl isn't available. Several can be written
+        to the same file one after the other.
+        """
+        chunks = [_BC_MAGIC, _BC_U32.pack(_BC_FORMAT_VERSION)]
+        _dump_instructions(chunks)
+        _dump_str(chunks, str(bytearray(self._bytecode)))
+        for strs in [self._literals, self._locals]:
+            _dump_u32(chunks, len(strs))
+            for s in strs:
+                _dump_str(chunks, s)
+        _dump_u32(chunks, len(self._auxs))
+        for auxtype, auxdata in self._auxs:
+            _dump_str(chunks, auxtype)
+            if auxdata is None:
+                _dump_u32(chunks, _BC_NO_AUXDATA)
+                continue
+            _dump_u32(chunks, len(auxdata))
+            for varlist in auxdata:
+                _dump_u32(chunks, len(varlist))
+                chunks.append(struct.pack('<%sI' % (len(varlist),), *varlist))
+        _dump_u32(chunks, self._pc)
+        chunks.append(chr(_BC_COMPILED[self.compiled]))
+        fileobj.write(''.join(chunks))
+    @classmethod
+    def load(cls, fileobj):
+        """
+        Read a BC written by `BC.dump` from a binary file object, raising
+        EOFError if there's nothing left to read. Where `_tcldis` isn't
+        available the instruction table is taken from the first BC loaded -
+        otherwise it must match the one in use.
+        """
+        magic = fileobj.read(len(_BC_MAGIC))
+        if magic == '':
+            raise EOFError('no BC dump to read')
+        if magic != _BC_MAGIC:
+            raise ValueError('not a BC dump')
+        version = _load_u32(fileobj)
+        if version != _BC_FORMAT_VERSION:
+            raise ValueError('unsupported BC dump version %s' % (version,))
+        _load_instructions(fileobj)
+        bytecode = bytearray(_load_str(fileobj))
+        literals, locals_ = [
+            [_load_str(fileobj).decode('utf-8') for _ in xrange(_load_u32(fileobj))]
+            for _ in range(2)
+        ]
+        auxs = []
+        for _ in xrange(_load_u32(fileobj)):
+            auxtype = _load_str(fileobj)
+            numvarlists = _load_u32(fileobj)
+            auxdata = None
+            if numvarlists != _BC_NO_AUXDATA:
+                auxdata = []
+                for _ in xrange(numvarlists):
+                    numvars = _load_u32(fileobj)
+                    auxdata.append(list(struct.unpack(
+                        '<%sI' % (numvars,), _load_exact(fileobj, 4 * numvars)
+                    )))
+            auxs.append((auxtype, auxdata))
+        pc = _load_u32(fileobj)
+        compiled = _load_compiled(ord(_load_exact(fileobj, 1)))
+        bc = cls(bytecode, literals, locals_, auxs, compiled)
+        bc.skip(pc)
+        return bc
+    def digest(self):
+        """
+        Returns a hex string identifying the content of this bytecode - the
+        instructions and the literal, local and aux tables. Identical bytecode
+        has the same digest whatever source it was compiled from.
+        """
+        if self._digest is None:
+            h = hashlib.sha1()
+            h.update('%s:' % (len(self._bytecode),))
+            h.update(self._bytecode)
+            h.update(repr((self._literals, self._locals, self._auxs)))
+            self._digest = h.hexdigest()
+        return self._digest
+
+def _resolveop(bc, opkind, op):
+    """
+    Given a decoded operand and its kind, look up what it refers to in the
+    tables of the bytecode.
+    """
+    if opkind == OPKIND_IMM:
+        return op
+    elif opkind == OPKIND_LOCAL:
+        return bc.local(op)
+    elif opkind == OPKIND_AUX:
+        auxtype, auxdata = bc.aux(op)
+        if auxtype == 'ForeachInfo':
+            auxdata = [
+                [bc.local(varidx) for varidx in varlist]
+                for varlist in auxdata
+            ]
+        else:
+            assert False
+        return (auxtype, auxdata)
+    else:
+        assert False
+
+# Inst and BCValue construct themselves from things other than their fields,
+# so they're unpickled by filling in the fields directly.
+def _restore_tuple(cls, fields):
+    return tuple.__new__(cls, fields)
 
 # Tcl bytecode instruction
 InstTuple = namedtuple('InstTuple', ['loc', 'name', 'ops', 'targetloc'])
 class Inst(InstTuple):
     def __new__(cls, bc):
-        d = {}
-        d['loc'] = bc.pc()
-        bytecode = bc.get(INSTRUCTIONS[bc.peek1()]['num_bytes'])
-        inst_type = INSTRUCTIONS[bytecode.pop(0)]
-        d['name'] = inst_type['name']
-        ops = []
-        for opnum in inst_type['operands']:
-            optype, getop = OPERANDS[opnum]
-            if optype in ['INT1', 'INT4', 'UINT1', 'UINT4']:
-                ops.append(getop(bytecode))
-            elif optype in ['LVT1', 'LVT4']:
-                ops.append(bc.local(getop(bytecode)))
-            elif optype in ['AUX4']:
-                ops.append(bc.aux(getop(bytecode)))
-                auxtype, auxdata = ops[-1]
-                if auxtype == 'ForeachInfo':
-                    auxdata = [
-                        [bc.local(varidx) for varidx in varlist]
-                        for varlist in auxdata
-                    ]
-                else:
-                    assert False
-                ops[-1] = (auxtype, auxdata)
-            else:
-                assert False
-        d['ops'] = tuple(ops)
+        loc = bc.pc()
+        decoder = INST_DECODERS[bc.peek1()]
+        assert decoder.opstruct is not None
+        ops = decoder.opstruct.unpack_from(bc.view(), loc + 1)
+        if decoder.resolve:
+            ops = tuple([
+                _resolveop(bc, opkind, op)
+                for opkind, op in zip(decoder.opkinds, ops)
+            ])
+        bc.skip(decoder.num_bytes)
 
         # Note that this doesn't get printed on str() so we only see
         # the value when it gets reduced to a BCJump class
-        d['targetloc'] = None
-        if d['name'] in JUMP_INSTRUCTIONS:
-            d['targetloc'] = d['loc'] + d['ops'][0]
+        targetloc = None
+        if decoder.jump:
+            targetloc = loc + ops[0]
 
-        return super(Inst, cls).__new__(cls, **d)
+        return super(Inst, cls).__new__(cls, loc, decoder.name, ops, targetloc)
 
     def __init__(self, bc, *args, **kwargs):
         super(Inst, self).__init__(*args, **kwargs)
+    def __reduce__(self):
+        return (_restore_tuple, (type(self), tuple(self)))
 
     def __str__(self):
         return '<%s: %s %s>' % (
@@ -159,10 +437,185 @@ class Inst(InstTuple):
             '(' + ', '.join([repr(o) for o in self.ops]) + ')',
         )
 
+def _packed_array(typecode, packed):
+    arr = array.array(typecode)
+    arr.fromstring(packed)
+    return arr
+
+def _decode_py(bc):
+    """
+    Pure Python version of the instruction decoding done by `_tcldis.decode`,
+    returning the locs, opcodes, opslots and targetlocs columns of an
+    InstStream. Kept as a reference for the C decoder.
+    """
+    numslots = max([len(decoder.opkinds) for decoder in INST_DECODERS])
+    locs = array.array('l')
+    opcodes = array.array('B')
+    opslots = [array.array('l') for _ in range(numslots)]
+    targetlocs = array.array('l')
+
+    bc = bc.copy()
+    view = bc.view()
+    padding = (0,) * numslots
+    while len(bc) > 0:
+        loc = bc.pc()
+        opcode = bc.peek1()
+        decoder = INST_DECODERS[opcode]
+        assert decoder.opstruct is not None
+        ops = decoder.opstruct.unpack_from(view, loc + 1)
+        locs.append(loc)
+        opcodes.append(opcode)
+        for opslot, op in zip(opslots, ops + padding):
+            opslot.append(op)
+        targetlocs.append(loc + ops[0] if decoder.jump else -1)
+        bc.skip(decoder.num_bytes)
+    return locs, opcodes, opslots, targetlocs
+
+# Columnar alternative to a list of Inst, for bulk analysis where the overhead
+# of an object per instruction adds up. Each column is an array with one item
+# per instruction. Operands are stored undecoded (i.e. as indexes into the
+# tables of the bytecode) with unused operand slots set to 0, and a targetloc
+# of -1 means the instruction is not a jump. Decoding is done in C if possible,
+# which also works out blockstarts - the indexes of the instructions that start
+# each basic block (or None).
+class InstStream(object):
+    def __init__(self, bc):
+        self._bc = bc.copy()
+        if _tcldis is None:
+            self.locs, self.opcodes, self.opslots, self.targetlocs = _decode_py(bc)
+            self.blockstarts = None
+            return
+        locs, opcodes, opslots, targetlocs, blockstarts = _tcldis.decode(
+            bc.view(), bc.pc()
+        )
+        self.locs = _packed_array('l', locs)
+        self.opcodes = _packed_array('B', opcodes)
+        self.opslots = [_packed_array('l', opslot) for opslot in opslots]
+        self.targetlocs = _packed_array('l', targetlocs)
+        self.blockstarts = _packed_array('l', blockstarts)
+    def __repr__(self):
+        return 'InstStream(%s insts)' % (len(self),)
+    def __len__(self):
+        return len(self.locs)
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('InstStream index out of range')
+        return InstRef(self, i)
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield InstRef(self, i)
+    def index(self, loc):
+        """
+        Given the location of an instruction, return its index in the stream.
+        """
+        i = bisect.bisect_left(self.locs, loc)
+        if i == len(self) or self.locs[i] != loc:
+            raise ValueError('no instruction at %s' % (loc,))
+        return i
+    def name(self, i):
+        return INST_DECODERS[self.opcodes[i]].name
+    def ops(self, i):
+        decoder = INST_DECODERS[self.opcodes[i]]
+        assert decoder.opstruct is not None
+        ops = tuple([opslot[i] for opslot in self.opslots[:len(decoder.opkinds)]])
+        if decoder.resolve:
+            ops = tuple([
+                _resolveop(self._bc, opkind, op)
+                for opkind, op in zip(decoder.opkinds, ops)
+            ])
+        return ops
+    def targetloc(self, i):
+        targetloc = self.targetlocs[i]
+        return None if targetloc == -1 else targetloc
+    def inst(self, i):
+        """
+        Create the Inst for the ith instruction.
+        """
+        return Inst._make((
+            self.locs[i], self.name(i), self.ops(i), self.targetloc(i)
+        ))
+    def insts(self):
+        """
+        Create Inst objects for all instructions, as returned by `getinsts`.
+        """
+        return [self.inst(i) for i in xrange(len(self))]
+
+# A lightweight view of a single instruction in an InstStream, with the same
+# attributes as an Inst
+class InstRef(object):
+    __slots__ = ('stream', 'idx')
+    def __init__(self, stream, idx):
+        self.stream = stream
+        self.idx = idx
+    def __repr__(self):
+        return 'InstRef(%s, %s)' % (self.idx, self.inst())
+    @property
+    def loc(self):
+        return self.stream.locs[self.idx]
+    @property
+    def name(self):
+        return self.stream.name(self.idx)
+    @property
+    def ops(self):
+        return self.stream.ops(self.idx)
+    @property
+    def targetloc(self):
+        return self.stream.targetloc(self.idx)
+    def inst(self):
+        return self.stream.inst(self.idx)
+
 #################################################################
 # My own representation of anything that can be used as a value #
 #################################################################
 
+# Accumulates the text of a decompiled tree. Nodes write themselves (and their
+# children) into a single writer rather than building and returning strings,
+# so each piece of output is only copied once no matter how deeply it's nested.
+# Nested blocks are indented by changing what a newline is written as.
+class Writer(object):
+    def __init__(self):
+        self.chunks = []
+        self.newline = u'\n'
+    def write(self, s):
+        if self.newline != u'\n' and u'\n' in s:
+            s = s.replace(u'\n', self.newline)
+        self.chunks.append(s)
+    def indent(self):
+        self.newline += u'\t'
+    def dedent(self):
+        assert self.newline != u'\n'
+        self.newline = self.newline[:-1]
+    def writenode(self, node):
+        # Reuse the text of anything already rendered by fmt(), which is most
+        # of the tree after the first step of decompilation
+        fmtcache = getattr(node, '_fmtcache', None)
+        if fmtcache is not None:
+            self.write(fmtcache)
+        else:
+            node.write(self)
+    def writeblock(self, bblock):
+        # Body of a braced block, on its own lines and one level in
+        self.indent()
+        self.write(u'\n')
+        self.writenode(bblock)
+        self.dedent()
+        self.write(u'\n')
+    def getvalue(self):
+        return u''.join(self.chunks)
+
+# fmt() is the same for all values, nonvalues and bblocks - they're immutable,
+# so the text is rendered once with write() and remembered.
+def _fmt_cached(self):
+    try:
+        return self._fmtcache
+    except AttributeError:
+        out = Writer()
+        self.write(out)
+        self._fmtcache = out.getvalue()
+        return self._fmtcache
+
 # The below represent my interpretation of the Tcl stack machine
 
 BCValueTuple = namedtuple('BCValueTuple', ['inst', 'value', 'stackn'])
@@ -185,8 +638,11 @@ class BCValue(BCValueTuple):
     def destack(self):
         assert self.stackn == 1
         return self._replace(stackn=self.stackn-1)
+    def __reduce__(self):
+        return (_restore_tuple, (type(self), tuple(self)))
     def __repr__(self): assert False
-    def fmt(self): assert False
+    fmt = _fmt_cached
+    def write(self, out): assert False
 
 class BCLiteral(BCValue):
     def __init__(self, *args, **kwargs):
@@ -194,18 +650,29 @@ class BCLiteral(BCValue):
         assert type(self.value) is unicode
     def __repr__(self):
         return 'BCLiteral(%s)' % (repr(self.value),)
-    def fmt(self):
+    # Characters that mean a literal can't be written bare, those that can
+    # only be written with escape codes, and the escapes for "" quoting
+    _specialre = re.compile(u'[$\\[\\]{}"\f\r\n\t\v ]')
+    _escapere = re.compile(u'[\f\r\v]')
+    _escapes = dict((ord(c), e) for c, e in [
+        (u'\\', u'\\\\'), (u'\f', u'\\f'), (u'\r', u'\\r'), (u'\n', u'\\n'),
+        (u'\t', u'\\t'), (u'\v', u'\\v'), (u'}', u'\\}'), (u'{', u'\\{'),
+        (u'"', u'\\"'), (u'[', u'\\['), (u']', u'\\]'), (u'$', u'\\$'),
+    ])
+    def write(self, out):
         val = self.value
-        if val == '': return u'{}'
-        if not any([c in val for c in '$[]{}""\f\r\n\t\v ']):
-            return val
+        if val == '':
+            out.write(u'{}')
+            return
+        if self._specialre.search(val) is None:
+            out.write(val)
+            return
 
         # Can't use simple case, go the hard route
         matching_brackets = True
         bracket_level = 0
-        for c in val:
-            if c == '{': bracket_level += 1
-            elif c == '}': bracket_level -= 1
+        for c in itertools.ifilter(u'{}'.__contains__, val):
+            bracket_level += 1 if c == '{' else -1
             if bracket_level < 0:
                 matching_brackets = False
                 break
@@ -213,26 +680,10 @@ class BCLiteral(BCValue):
         # Note we don't try and match \n or \t - these are probably used
         # in multiline strings, so if possible use {} quoting and print
         # them literally.
-        if any([c in val for c in '\f\r\v']) or not matching_brackets:
-            val = (val
-                .replace('\\', '\\\\')
-                .replace('\f', '\\f')
-                .replace('\r', '\\r')
-                .replace('\n', '\\n')
-                .replace('\t', '\\t')
-                .replace('\v', '\\v')
-                .replace('}', '\\}')
-                .replace('{', '\\{')
-                .replace('"', '\\"')
-                .replace('"', '\\"')
-                .replace('[', '\\[')
-                .replace(']', '\\]')
-                .replace('$', '\\$')
-            )
-            val = u'"%s"' % (val,)
+        if self._escapere.search(val) is not None or not matching_brackets:
+            out.write(u'"%s"' % (val.translate(self._escapes),))
         else:
-            val = u'{%s}' % (val,)
-        return val
+            out.write(u'{%s}' % (val,))
 
 class BCVarRef(BCValue):
     def __init__(self, *args, **kwargs):
@@ -240,8 +691,9 @@ class BCVarRef(BCValue):
         assert len(self.value) == 1
     def __repr__(self):
         return 'BCVarRef(%s)' % (repr(self.value),)
-    def fmt(self):
-        return u'$' + self.value[0].fmt()
+    def write(self, out):
+        out.write(u'$')
+        out.writenode(self.value[0])
 
 class BCArrayRef(BCValue):
     def __init__(self, *args, **kwargs):
@@ -249,8 +701,12 @@ class BCArrayRef(BCValue):
         assert len(self.value) == 2
     def __repr__(self):
         return 'BCArrayRef(%s)' % (repr(self.value),)
-    def fmt(self):
-        return u'$%s(%s)' % (self.value[0].fmt(), self.value[1].fmt())
+    def write(self, out):
+        out.write(u'$')
+        out.writenode(self.value[0])
+        out.write(u'(')
+        out.writenode(self.value[1])
+        out.write(u')')
 
 class BCConcat(BCValue):
     def __init__(self, *args, **kwargs):
@@ -258,10 +714,13 @@ class BCConcat(BCValue):
         assert len(self.value) > 1
     def __repr__(self):
         return 'BCConcat(%s)' % (repr(self.value),)
-    def fmt(self):
+    def write(self, out):
         # TODO: this won't always work, need to be careful of
         # literals following variables
-        return u'"%s"' % (u''.join([v.fmt() for v in self.value]),)
+        out.write(u'"')
+        for v in self.value:
+            out.writenode(v)
+        out.write(u'"')
 
 class BCProcCall(BCValue):
     def __init__(self, *args, **kwargs):
@@ -269,14 +728,15 @@ class BCProcCall(BCValue):
         assert len(self.value) >= 1
     def __repr__(self):
         return 'BCProcCall(%s)' % (self.value,)
-    def fmt(self):
+    def write(self, out):
         args = list(self.value)
         if args[0].fmt() == u'::tcl::array::set':
             args[0:1] = [BCLiteral(None, 'array'), BCLiteral(None, 'set')]
-        cmd = u' '.join([arg.fmt() for arg in args])
-        if self.stackn:
-            cmd = u'[%s]' % (cmd,)
-        return cmd
+        if self.stackn: out.write(u'[')
+        for i, arg in enumerate(args):
+            if i > 0: out.write(u' ')
+            out.writenode(arg)
+        if self.stackn: out.write(u']')
 
 class BCSet(BCProcCall):
     def __init__(self, *args, **kwargs):
@@ -284,11 +744,13 @@ class BCSet(BCProcCall):
         assert len(self.value) == 2
     def __repr__(self):
         return 'BCSet(%s)' % (self.value,)
-    def fmt(self):
-        cmd = u'set %s %s' % tuple([v.fmt() for v in self.value])
-        if self.stackn:
-            cmd = u'[%s]' % (cmd,)
-        return cmd
+    def write(self, out):
+        if self.stackn: out.write(u'[')
+        out.write(u'set ')
+        out.writenode(self.value[0])
+        out.write(u' ')
+        out.writenode(self.value[1])
+        if self.stackn: out.write(u']')
 
 # This one is odd. inst.ops[0] is the index to the locals table, kv[0]
 # is namespace::value, or value if looking at the same namespace (i.e.
@@ -304,11 +766,11 @@ class BCVariable(BCProcCall):
         assert self.value[0].fmt().endswith(self.inst.ops[0])
     def __repr__(self):
         return 'BCVariable(%s)' % (self.value,)
-    def fmt(self):
-        cmd = u'variable %s' % (self.value[0].fmt(),)
-        if self.stackn:
-            cmd = u'[%s]' % (cmd,)
-        return cmd
+    def write(self, out):
+        if self.stackn: out.write(u'[')
+        out.write(u'variable ')
+        out.writenode(self.value[0])
+        if self.stackn: out.write(u']')
 
 class BCExpr(BCValue):
     _exprmap = {
@@ -334,8 +796,8 @@ class BCExpr(BCValue):
         elif nargs == 2:
             expr = u'%s %s %s' % (self.value[0].fmt(), op, self.value[1].fmt())
         return expr
-    def fmt(self):
-        return u'[expr {%s}]' % (self.expr(),)
+    def write(self, out):
+        out.write(u'[expr {%s}]' % (self.expr(),))
 
 class BCReturn(BCProcCall):
     def __init__(self, *args, **kwargs):
@@ -346,9 +808,12 @@ class BCReturn(BCProcCall):
         assert self.inst.ops[1] == 1 # Level
     def __repr__(self):
         return 'BCReturn(%s)' % (repr(self.value),)
-    def fmt(self):
-        if self.value[0].value == '': return u'return'
-        return u'return %s' % (self.value[0].fmt(),)
+    def write(self, out):
+        if self.value[0].value == '':
+            out.write(u'return')
+            return
+        out.write(u'return ')
+        out.writenode(self.value[0])
 
 # TODO: I'm totally unsure about where this goes. tclCompile.c says it has a -1
 # stack effect, which means it doesn't put anything back on the stack. But
@@ -364,11 +829,13 @@ class BCDone(BCProcCall):
         assert len(self.value) == 1
     def __repr__(self):
         return 'BCDone(%s)' % (repr(self.value),)
-    def fmt(self):
+    def write(self, out):
         # In the general case it's impossible to guess whether 'return' was written.
         if isinstance(self.value[0], BCProcCall):
-            return self.value[0].destack().fmt()
-        return u'return %s' % (self.value[0].fmt(),)
+            out.writenode(self.value[0].destack())
+            return
+        out.write(u'return ')
+        out.writenode(self.value[0])
 
 # self.value contains two bblocks, self.inst contains two jumps
 class BCIf(BCProcCall):
@@ -379,7 +846,7 @@ class BCIf(BCProcCall):
         assert self.inst[0].on in (True, False) and self.inst[1].on is None
     def __repr__(self):
         return 'BCIf(%s)' % (self.value,)
-    def fmt(self):
+    def write(self, out):
         value = list(self.value)
         # An if condition takes 'ownership' of the values returned in any
         # of its branches
@@ -401,16 +868,15 @@ class BCIf(BCProcCall):
             conditionstr = self.inst[0].value[0].fmt()
             if self.inst[0].on is True:
                 conditionstr = '!%s' % (conditionstr,)
-        cmd = (
-            u'if {%s} {\n\t%s\n}' % (conditionstr, value[0].fmt().replace('\n', '\n\t'))
-        )
+        if self.stackn: out.write(u'[')
+        out.write(u'if {%s} {' % (conditionstr,))
+        out.writeblock(value[0])
+        out.write(u'}')
         if len(value[1].insts) > 0:
-            cmd += (
-                u' else {\n\t%s\n}' % (value[1].fmt().replace('\n', '\n\t'),)
-            )
-        if self.stackn:
-            cmd = u'[%s]' % (cmd,)
-        return cmd
+            out.write(u' else {')
+            out.writeblock(value[1])
+            out.write(u'}')
+        if self.stackn: out.write(u']')
 
 class BCCatch(BCProcCall):
     def __init__(self, *args, **kwargs):
@@ -437,17 +903,17 @@ class BCCatch(BCProcCall):
         ]))
     def __repr__(self):
         return 'BCCatch(%s)' % (self.value,)
-    def fmt(self):
+    def write(self, out):
         begin, _, end = self.value
         # Nail down the details and move things around to our liking
         begin = begin.replaceinst((-3, -2), [begin.insts[-3].destack()])
         begin = begin.popinst().popinst().replaceinst(0, [])
-        catchblock = begin.fmt()
         varname = end.insts[2].ops[0]
-        cmd = u'catch {%s} %s' % (catchblock, varname)
-        if self.stackn:
-            cmd = u'[%s]' % (cmd,)
-        return cmd
+        if self.stackn: out.write(u'[')
+        out.write(u'catch {')
+        out.writenode(begin)
+        out.write(u'} %s' % (varname,))
+        if self.stackn: out.write(u']')
 
 class BCForeach(BCProcCall):
     def __init__(self, *args, **kwargs):
@@ -477,17 +943,18 @@ class BCForeach(BCProcCall):
         assert len(begin.insts[1].ops[0][1]) == 1
     def __repr__(self):
         return 'BCForeach(%s)' % (self.value,)
-    def fmt(self):
+    def write(self, out):
         value = list(self.value)
         value[2] = value[2].popinst()
         # TODO: this is lazy
         fevars = ' '.join(value[0].insts[1].ops[0][1][0])
-        felist = value[0].insts[0].value[1].fmt()
-        feblock = '\n\t' + value[2].fmt().replace('\n', '\n\t') + '\n'
-        cmd = u'foreach {%s} %s {%s}' % (fevars, felist, feblock)
-        if self.stackn:
-            cmd = u'[%s]' % (cmd,)
-        return cmd
+        if self.stackn: out.write(u'[')
+        out.write(u'foreach {%s} ' % (fevars,))
+        out.writenode(value[0].insts[0].value[1])
+        out.write(u' {')
+        out.writeblock(value[2])
+        out.write(u'}')
+        if self.stackn: out.write(u']')
 
 ####################################################################
 # My own representation of anything that cannot be used as a value #
@@ -498,8 +965,14 @@ class BCNonValue(object):
         super(BCNonValue, self).__init__(*args, **kwargs)
         self.inst = inst
         self.value = value
+    def __getstate__(self):
+        # Formatting is cheaper to redo than to pickle
+        state = self.__dict__.copy()
+        state.pop('_fmtcache', None)
+        return state
     def __repr__(self): assert False
-    def fmt(self): assert False
+    fmt = _fmt_cached
+    def write(self, out): assert False
 
 class BCJump(BCNonValue):
     def __init__(self, on, *args, **kwargs):
@@ -512,9 +985,9 @@ class BCJump(BCNonValue):
         if self.on is not None:
             condition = '(%s==%s)' % (self.on, self.value)
         return 'BCJump%s->%s' % (condition, self.inst.targetloc)
-    def fmt(self):
+    def write(self, out):
         #return 'JUMP%s(%s)' % (self.on, self.value[0].fmt())
-        return unicode(self)
+        out.write(unicode(self))
 
 # Just a formatting container for the form a(x)
 class BCArrayElt(BCNonValue):
@@ -523,55 +996,714 @@ class BCArrayElt(BCNonValue):
         assert len(self.value) == 2
     def __repr__(self):
         return 'BCArrayElt(%s)' % (repr(self.value),)
-    def fmt(self):
-        return u'%s(%s)' % (self.value[0].fmt(), self.value[1].fmt())
+    def write(self, out):
+        out.writenode(self.value[0])
+        out.write(u'(')
+        out.writenode(self.value[1])
+        out.write(u')')
 
 ##############################
 # Any basic block structures #
 ##############################
 
+# Persistent sequence of instructions, used as the storage for basic blocks.
+# It is an immutable AVL-balanced tree with tuples of up to LEAFSIZE items at
+# the leaves, so splicing produces a new sequence sharing everything but the
+# O(log n) nodes along the edit path, and the original stays a valid snapshot.
+# Otherwise it behaves like a tuple of its items - including comparing equal to
+# (and hashing the same as) one.
+class InstSeq(object):
+    LEAFSIZE = 64
+    __slots__ = ('_left', '_right', '_items', '_len', '_height')
+    def __init__(self, items=()):
+        # Build a balanced tree by recursive halving over full leaves
+        items = tuple(items)
+        if len(items) <= self.LEAFSIZE:
+            self._setleaf(items)
+            return
+        numleaves = (len(items) + self.LEAFSIZE - 1) // self.LEAFSIZE
+        half = (numleaves // 2) * self.LEAFSIZE
+        self._setnode(InstSeq(items[:half]), InstSeq(items[half:]))
+    def _setleaf(self, items):
+        self._left = self._right = None
+        self._items = items
+        self._len = len(items)
+        self._height = 1 if items else 0
+    def _setnode(self, left, right):
+        self._left = left
+        self._right = right
+        self._items = None
+        self._len = left._len + right._len
+        self._height = max(left._height, right._height) + 1
+    @classmethod
+    def _leaf(cls, items):
+        seq = cls.__new__(cls)
+        seq._setleaf(items)
+        return seq
+    @classmethod
+    def _node(cls, left, right):
+        seq = cls.__new__(cls)
+        seq._setnode(left, right)
+        return seq
+    @classmethod
+    def _rebalance(cls, left, right):
+        if left._height > right._height + 1:
+            if left._left._height < left._right._height:
+                left = cls._node(cls._node(left._left, left._right._left), left._right._right)
+            return cls._node(left._left, cls._node(left._right, right))
+        if right._height > left._height + 1:
+            if right._right._height < right._left._height:
+                right = cls._node(right._left._left, cls._node(right._left._right, right._right))
+            return cls._node(cls._node(left, right._left), right._right)
+        return cls._node(left, right)
+    def _join(self, other):
+        if other._len == 0: return self
+        if self._len == 0: return other
+        if (self._items is not None and other._items is not None and
+                self._len + other._len <= self.LEAFSIZE):
+            return self._leaf(self._items + other._items)
+        if self._height > other._height + 1:
+            return self._rebalance(self._left, self._right._join(other))
+        if other._height > self._height + 1:
+            return self._rebalance(self._join(other._left), other._right)
+        return self._node(self, other)
+    def _split(self, i):
+        if i <= 0: return InstSeq(), self
+        if i >= self._len: return self, InstSeq()
+        if self._items is not None:
+            return self._leaf(self._items[:i]), self._leaf(self._items[i:])
+        leftlen = self._left._len
+        if i <= leftlen:
+            before, after = self._left._split(i)
+            return before, after._join(self._right)
+        before, after = self._right._split(i - leftlen)
+        return self._left._join(before), after
+    def __repr__(self):
+        return 'InstSeq(%s)' % (repr(tuple(self)),)
+    def __reduce__(self):
+        # Only the items matter, the tree is rebuilt balanced
+        return (InstSeq, (tuple(self),))
+    def __len__(self):
+        return self._len
+    def __iter__(self):
+        stack = [self]
+        while stack:
+            seq = stack.pop()
+            if seq._items is not None:
+                for item in seq._items:
+                    yield item
+            else:
+                stack.append(seq._right)
+                stack.append(seq._left)
+    def __reversed__(self):
+        stack = [self]
+        while stack:
+            seq = stack.pop()
+            if seq._items is not None:
+                for item in reversed(seq._items):
+                    yield item
+            else:
+                stack.append(seq._left)
+                stack.append(seq._right)
+    def __getitem__(self, i):
+        if type(i) is slice:
+            start, stop, step = i.indices(self._len)
+            if step != 1:
+                return InstSeq(tuple(self)[i])
+            before, _ = self._split(max(start, stop))
+            return before._split(start)[1]
+        if i < 0:
+            i += self._len
+        if not 0 <= i < self._len:
+            raise IndexError('InstSeq index out of range')
+        seq = self
+        while seq._items is None:
+            if i < seq._left._len:
+                seq = seq._left
+            else:
+                i -= seq._left._len
+                seq = seq._right
+        return seq._items[i]
+    def __eq__(self, other):
+        if not isinstance(other, (InstSeq, tuple)):
+            return NotImplemented
+        if other is self:
+            return True
+        return len(self) == len(other) and all(
+            a == b for a, b in itertools.izip(self, other)
+        )
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+    def __hash__(self):
+        return hash(tuple(self))
+    def count(self, item):
+        return sum([1 for x in self if x == item])
+    def index(self, item):
+        for i, x in enumerate(self):
+            if x == item:
+                return i
+        raise ValueError('InstSeq.index(x): x not in sequence')
+    def __add__(self, other):
+        if type(other) is not InstSeq:
+            other = InstSeq(other)
+        return self._join(other)
+    def splice(self, i, j, items):
+        """
+        Return a new sequence with the slice i:j replaced by the given items,
+        as for list slice assignment.
+        """
+        i, j, _ = slice(i, j).indices(self._len)
+        before, rest = self._split(i)
+        _, after = rest._split(j - i)
+        if type(items) is not InstSeq:
+            items = InstSeq(items)
+        return before._join(items)._join(after)
+
 # Basic block, containing a linear flow of logic
 class BBlock(object):
     def __init__(self, insts, loc, *args, **kwargs):
         super(BBlock, self).__init__(*args, **kwargs)
-        assert type(insts) is list
+        assert type(insts) in (list, InstSeq)
         assert type(loc) is int
-        self.insts = tuple(insts)
+        self.insts = insts if type(insts) is InstSeq else InstSeq(insts)
         self.loc = loc
     def __repr__(self):
         return 'BBlock(at %s, %s insts)' % (self.loc, len(self.insts))
+    def __reduce__(self):
+        return (BBlock, (self.insts, self.loc))
     def replaceinst(self, ij, replaceinsts):
-        newinsts = list(self.insts)
         if type(ij) is not tuple:
             assert ij >= 0
             ij = (ij, ij+1)
-        assert type(replaceinsts) is list
-        newinsts[ij[0]:ij[1]] = replaceinsts
-        return BBlock(newinsts, self.loc)
+        assert type(replaceinsts) in (list, InstSeq)
+        return BBlock(self.insts.splice(ij[0], ij[1], replaceinsts), self.loc)
     def appendinsts(self, insts):
         return self.replaceinst((len(self.insts), len(self.insts)), insts)
     def popinst(self):
         return self.replaceinst(len(self.insts)-1, [])
-    def fmt_insts(self):
-        fmt_list = []
-        for inst in self.insts:
-            if isinstance(inst, Inst):
-                fmt_str = unicode(inst)
-            elif (isinstance(inst, BCValue) and not isinstance(inst, BCDone) and
-                    inst.stackn == 1):
-                # BCDone is an odd one - it leaves something on the stack.
-                # That's ok, it's usually because we've compiled a proc body
-                # and the stack value is the return value - so we don't want to
-                # display a stack indicator, but we do want to leave stackn as 1
-                # for programmatic inspection.
-                # >> symbol
-                fmt_str = u'\u00bb %s' % (inst.fmt(),)
-            else:
-                fmt_str = inst.fmt()
-            fmt_list.append(fmt_str)
+    @staticmethod
+    def _stacked(inst):
+        # BCDone is an odd one - it leaves something on the stack.
+        # That's ok, it's usually because we've compiled a proc body
+        # and the stack value is the return value - so we don't want to
+        # display a stack indicator, but we do want to leave stackn as 1
+        # for programmatic inspection.
+        return (isinstance(inst, BCValue) and not isinstance(inst, BCDone) and
+            inst.stackn == 1)
+    def fmt_insts(self, i=0, j=None):
+        """
+        Returns a list of the formatted lines of the instructions in the slice
+        i:j of this block.
+        """
+        # The same bblock turns up in many steps of decompilation, so the
+        # lines of the whole block are only formatted once
+        if hasattr(self, '_fmtlines'):
+            return self._fmtlines[i:j]
+        fmt_list = [self._fmt_inst(inst) for inst in self.insts[i:j]]
+        if (i, j) == (0, None):
+            self._fmtlines = fmt_list
+            return list(fmt_list)
         return fmt_list
-    def fmt(self):
-        return u'\n'.join(self.fmt_insts())
+    def _fmt_inst(self, inst):
+        # Most instructions survive many steps unchanged, so keep the text of
+        # each for writeinst to reuse
+        if not isinstance(inst, Inst):
+            inst.fmt()
+        out = Writer()
+        self.writeinst(out, inst)
+        return out.getvalue()
+    fmt = _fmt_cached
+    def write(self, out):
+        for i, inst in enumerate(self.insts):
+            if i > 0: out.write(u'\n')
+            self.writeinst(out, inst)
+    def writeinst(self, out, inst):
+        if isinstance(inst, Inst):
+            out.write(unicode(inst))
+            return
+        if self._stacked(inst):
+            # >> symbol
+            out.write(u'\u00bb ')
+        out.writenode(inst)
+
+#########################
+# Decompilation caching #
+#########################
+
+# Results of decompilation kept against the digest of the bytecode they came
+# from, so the same bytecode is only decompiled once however it was obtained.
+# The least recently used entries are evicted once there are more than
+# `maxentries` or they take up more than `maxbytes` (approximately).
+class DecompileCache(object):
+    def __init__(self, maxentries=1024, maxbytes=64*1024*1024):
+        super(DecompileCache, self).__init__()
+        assert maxentries > 0 and maxbytes > 0
+        self.maxentries = maxentries
+        self.maxbytes = maxbytes
+        self.clear()
+    def __repr__(self):
+        return 'DecompileCache(%s entries, %s bytes)' % (len(self), self.nbytes)
+    def __len__(self):
+        return len(self._entries)
+    def __contains__(self, key):
+        return key in self._entries
+    def clear(self):
+        self._entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+    def get(self, key):
+        """
+        Returns the value stored against `key`, or None if there isn't one.
+        """
+        try:
+            value, size = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries[key] = (value, size)
+        self.hits += 1
+        return value
+    def put(self, key, value, size):
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key)[1]
+        if size > self.maxbytes:
+            return
+        self._entries[key] = (value, size)
+        self.nbytes += size
+        while len(self._entries) > self.maxentries or self.nbytes > self.maxbytes:
+            _, (_, oldsize) = self._entries.popitem(last=False)
+            self.nbytes -= oldsize
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self),
+            'bytes': self.nbytes,
+        }
+
+# The same interface as DecompileCache, but kept in an sqlite database so it
+# persists between runs and can be shared by processes working at the same
+# time. Results are only valid for the version of tcldis that produced them
+# and the version of Tcl the bytecode came from, so both are part of the key.
+# The least recently used entries are evicted once the (pickled) results take
+# up more than `maxbytes`, which is checked against a running total kept in the
+# database alongside them.
+class DiskCache(object):
+    def __init__(self, path, maxbytes=1024*1024*1024):
+        super(DiskCache, self).__init__()
+        assert maxbytes > 0
+        self.path = path
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+    def __repr__(self):
+        return 'DiskCache(%s)' % (repr(self.path),)
+    def __len__(self):
+        return self._conn().execute('SELECT COUNT(*) FROM results').fetchone()[0]
+    def __contains__(self, key):
+        return self._conn().execute(
+            'SELECT 1 FROM results WHERE ' + self._keywhere, self._keyargs(key)
+        ).fetchone() is not None
+    def _conn(self):
+        # sqlite connections can't be carried across a fork or used by more
+        # than one thread, so each thread of each process gets its own
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS results (
+                    kind TEXT, engine TEXT, digest TEXT, pc INTEGER,
+                    tcldis_version TEXT, tcl_version TEXT,
+                    value BLOB, size INTEGER, atime REAL,
+                    PRIMARY KEY (
+                        kind, engine, digest, pc, tcldis_version, tcl_version
+                    )
+                )
+            """)
+            db.execute(
+                'CREATE INDEX IF NOT EXISTS results_atime ON results (atime)'
+            )
+            # A single row holding the total size of the results
+            db.execute('CREATE TABLE IF NOT EXISTS meta (nbytes INTEGER)')
+            db.execute(
+                'INSERT INTO meta SELECT COALESCE(SUM(size), 0) FROM results ' +
+                'WHERE NOT EXISTS (SELECT 1 FROM meta)'
+            )
+            local.db = db
+            local.pid = os.getpid()
+        return local.db
+    @property
+    def _versions(self):
+        # Looked up each time as loading a BC dump may set the Tcl version, and
+        # never NULL so that it always matches itself in the key
+        return (__version__, TCL_PATCH_LEVEL or '')
+    _keywhere = (
+        'kind = ? AND engine = ? AND digest = ? AND pc = ? AND ' +
+        'tcldis_version = ? AND tcl_version = ?'
+    )
+    def _keyargs(self, key):
+        return tuple(key) + self._versions
+    def clear(self):
+        db = self._conn()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('DELETE FROM results')
+            db.execute('UPDATE meta SET nbytes = 0')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+        self.hits = 0
+        self.misses = 0
+    def get(self, key):
+        """
+        Returns the value stored against `key`, or None if there isn't one.
+        """
+        db = self._conn()
+        row = db.execute(
+            'SELECT value FROM results WHERE ' + self._keywhere, self._keyargs(key)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        db.execute(
+            'UPDATE results SET atime = ? WHERE ' + self._keywhere,
+            (time.time(),) + self._keyargs(key)
+        )
+        self.hits += 1
+        return pickle.loads(str(row[0]))
+    def put(self, key, value, size):
+        # The size that matters here is what's on disk
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(value) > self.maxbytes:
+            return
+        db = self._conn()
+        keyargs = self._keyargs(key)
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute(
+                'SELECT size FROM results WHERE ' + self._keywhere, keyargs
+            ).fetchone()
+            db.execute(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                keyargs + (buffer(value), len(value), time.time())
+            )
+            db.execute(
+                'UPDATE meta SET nbytes = nbytes + ?',
+                (len(value) - (row[0] if row is not None else 0),)
+            )
+            nbytes = db.execute('SELECT nbytes FROM meta').fetchone()[0]
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+        if nbytes > self.maxbytes:
+            self.prune(self.maxbytes)
+    def prune(self, maxbytes=None, stale=False):
+        """
+        Evicts the least recently used entries until they take up no more than
+        `maxbytes`, and if `stale` is true, any entries from other versions of
+        tcldis or Tcl.
+        """
+        db = self._conn()
+        # Take the write lock up front so concurrent prunes don't interleave
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            if stale:
+                db.execute(
+                    'DELETE FROM results WHERE tcldis_version != ? OR tcl_version != ?',
+                    self._versions
+                )
+                db.execute(
+                    'UPDATE meta SET nbytes = ' +
+                    '(SELECT COALESCE(SUM(size), 0) FROM results)'
+                )
+            if maxbytes is not None:
+                nbytes = db.execute('SELECT nbytes FROM meta').fetchone()[0]
+                evict = []
+                rows = db.execute('SELECT rowid, size FROM results ORDER BY atime')
+                for rowid, size in rows:
+                    if nbytes <= maxbytes: break
+                    evict.append((rowid,))
+                    nbytes -= size
+                db.executemany('DELETE FROM results WHERE rowid = ?', evict)
+                db.execute('UPDATE meta SET nbytes = ?', (nbytes,))
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self),
+            'bytes': self._conn().execute('SELECT nbytes FROM meta').fetchone()[0],
+        }
+
+# Archive of many BCs in one file, read through mmap so that looking up a proc
+# only touches its index entries, its record and the strings it uses. Procs
+# with the same content share a record, and each distinct string is stored
+# once in a pool that records refer to by index. All integers are little
+# endian. The file is laid out as:
+#  - the header: magic, format version, number of procs and the offsets of the
+#    instruction table, string pool, name index and digest index
+#  - a record per distinct bytecode: the bytecode, pc and compiled (as in
+#    BC.dump), then the literal and local tables and auxs with every string
+#    replaced by its pool index
+#  - the instruction table, as in BC.dump
+#  - the string pool: the number of strings, that plus one offsets into the
+#    string data (string i is between offsets i and i + 1), then the data
+#  - the name index: an entry per proc of its name's pool index, binary sha1
+#    digest and record offset, sorted by name
+#  - the digest index: the positions of the entries in the name index, sorted
+#    by digest
+_AR_MAGIC = 'TCLDISAR'
+_AR_FORMAT_VERSION = 1
+_AR_HEADER = struct.Struct('<8sIIQQQQ')
+_AR_ENTRY = struct.Struct('<I20sQ')
+_AR_STRSPAN = struct.Struct('<II')
+_AR_PCCOMPILED = struct.Struct('<IB')
+
+# Writes BCs to a new archive at `path`, to be read with BCArchive. Records are
+# written as BCs are added and everything else once all have been, on close.
+class BCArchiveWriter(object):
+    def __init__(self, path):
+        assert INSTRUCTIONS is not None
+        self.path = path
+        self._f = open(path, 'wb')
+        self._f.write('\0' * _AR_HEADER.size)
+        # String -> pool index
+        self._strs = {}
+        # Name -> (name pool index, digest, record offset)
+        self._entries = {}
+        # (digest, pc, compiled) -> record offset
+        self._records = {}
+    def __repr__(self):
+        return 'BCArchiveWriter(%s)' % (repr(self.path),)
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc_info):
+        self.close()
+    def _stridx(self, s):
+        if type(s) is unicode:
+            s = s.encode('utf-8')
+        idx = self._strs.get(s)
+        if idx is None:
+            idx = self._strs[s] = len(self._strs)
+        return idx
+    def _dump_stridxs(self, chunks, strs):
+        stridxs = [self._stridx(s) for s in strs]
+        chunks.append(struct.pack('<I%sI' % (len(stridxs),), len(stridxs), *stridxs))
+    def add(self, name, bc):
+        """
+        Add a BC to the archive under `name`, usually a fully qualified proc
+        name.
+        """
+        if type(name) is unicode:
+            name = name.encode('utf-8')
+        if name in self._entries:
+            raise ValueError('%s is already in the archive' % (name,))
+        digest = binascii.unhexlify(bc.digest())
+        key = (digest, bc.pc(), bc.compiled)
+        offset = self._records.get(key)
+        if offset is None:
+            offset = self._records[key] = self._f.tell()
+            chunks = []
+            _dump_str(chunks, str(bytearray(bc._bytecode)))
+            chunks.append(_AR_PCCOMPILED.pack(bc.pc(), _BC_COMPILED[bc.compiled]))
+            self._dump_stridxs(chunks, bc._literals)
+            self._dump_stridxs(chunks, bc._locals)
+            _dump_u32(chunks, len(bc._auxs))
+            for auxtype, auxdata in bc._auxs:
+                _dump_u32(chunks, self._stridx(auxtype))
+                if auxdata is None:
+                    _dump_u32(chunks, _BC_NO_AUXDATA)
+                    continue
+                _dump_u32(chunks, len(auxdata))
+                for varlist in auxdata:
+                    chunks.append(struct.pack(
+                        '<I%sI' % (len(varlist),), len(varlist), *varlist
+                    ))
+            self._f.write(''.join(chunks))
+        self._entries[name] = (self._stridx(name), digest, offset)
+    def close(self):
+        """
+        Finish writing the archive.
+        """
+        if self._f is None:
+            return
+        f = self._f
+        chunks = []
+        _dump_instructions(chunks)
+        instoff = f.tell()
+        f.write(''.join(chunks))
+
+        pooloff = f.tell()
+        strs = sorted(self._strs, key=self._strs.get)
+        stroffs = [0]
+        for s in strs:
+            stroffs.append(stroffs[-1] + len(s))
+        assert stroffs[-1] < 2**32
+        f.write(struct.pack('<I%sI' % (len(stroffs),), len(strs), *stroffs))
+        f.write(''.join(strs))
+
+        nameidxoff = f.tell()
+        entries = [self._entries[name] for name in sorted(self._entries)]
+        f.write(''.join([_AR_ENTRY.pack(*entry) for entry in entries]))
+        digestidxoff = f.tell()
+        bydigest = sorted(xrange(len(entries)), key=lambda i: entries[i][1])
+        f.write(struct.pack('<%sI' % (len(bydigest),), *bydigest))
+
+        f.seek(0)
+        f.write(_AR_HEADER.pack(
+            _AR_MAGIC, _AR_FORMAT_VERSION, len(entries),
+            instoff, pooloff, nameidxoff, digestidxoff
+        ))
+        f.close()
+        self._f = None
+
+# Read only access to an archive written by BCArchiveWriter (or
+# write_archive), as a mapping of name -> BC. BCs are created when they're
+# looked up. Literals and locals are only decoded once, so procs using the same
+# string share it.
+class BCArchive(object):
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mm) < _AR_HEADER.size:
+            raise ValueError('not a BC archive')
+        (
+            magic, version, self._numprocs,
+            instoff, self._pooloff, self._nameidxoff, self._digestidxoff
+        ) = _AR_HEADER.unpack_from(self._mm)
+        if magic != _AR_MAGIC:
+            raise ValueError('not a BC archive')
+        if version != _AR_FORMAT_VERSION:
+            raise ValueError('unsupported BC archive version %s' % (version,))
+        self._mm.seek(instoff)
+        _load_instructions(self._mm)
+        numstrs = _BC_U32.unpack_from(self._mm, self._pooloff)[0]
+        self._strdataoff = self._pooloff + _BC_U32.size * (numstrs + 2)
+        # Pool index -> unicode
+        self._unicodes = {}
+    def __repr__(self):
+        return 'BCArchive(%s)' % (repr(self.path),)
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc_info):
+        self.close()
+    def __len__(self):
+        return self._numprocs
+    def __contains__(self, name):
+        return self._find(name) is not None
+    def __iter__(self):
+        for i in xrange(self._numprocs):
+            yield self._str(self._entry(i)[0])
+    def __getitem__(self, name):
+        found = self._find(name)
+        if found is None:
+            raise KeyError(name)
+        return self._bc(*found)
+    def keys(self):
+        return list(self)
+    def get(self, name, default=None):
+        found = self._find(name)
+        return self._bc(*found) if found is not None else default
+    def bydigest(self, digest):
+        """
+        Returns a BC with the given digest (see `BC.digest`), whatever name it
+        was added under. Raises KeyError if there isn't one.
+        """
+        rawdigest = binascii.unhexlify(digest)
+        lo, hi = 0, self._numprocs
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(self._bydigest(mid))[1] < rawdigest:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._numprocs:
+            _, entrydigest, offset = self._entry(self._bydigest(lo))
+            if entrydigest == rawdigest:
+                return self._bc(entrydigest, offset)
+        raise KeyError(digest)
+    def close(self):
+        self._mm.close()
+    def _str(self, idx):
+        start, end = _AR_STRSPAN.unpack_from(
+            self._mm, self._pooloff + _BC_U32.size * (idx + 1)
+        )
+        return self._mm[self._strdataoff + start:self._strdataoff + end]
+    def _unicode(self, idx):
+        s = self._unicodes.get(idx)
+        if s is None:
+            s = self._unicodes[idx] = self._str(idx).decode('utf-8')
+        return s
+    def _entry(self, i):
+        return _AR_ENTRY.unpack_from(self._mm, self._nameidxoff + _AR_ENTRY.size * i)
+    def _bydigest(self, i):
+        return _BC_U32.unpack_from(self._mm, self._digestidxoff + _BC_U32.size * i)[0]
+    def _find(self, name):
+        """
+        Binary search the name index, returning the digest and record offset for
+        `name` or None.
+        """
+        if type(name) is unicode:
+            name = name.encode('utf-8')
+        lo, hi = 0, self._numprocs
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._str(self._entry(mid)[0]) < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._numprocs:
+            nameidx, digest, offset = self._entry(lo)
+            if self._str(nameidx) == name:
+                return digest, offset
+        return None
+    def _bc(self, digest, offset):
+        mm = self._mm
+        u32 = lambda: _BC_U32.unpack_from(mm, pos)[0]
+        pos = offset
+        bclen = u32()
+        pos += _BC_U32.size
+        bytecode = bytearray(mm[pos:pos + bclen])
+        pos += bclen
+        pc, compiled = _AR_PCCOMPILED.unpack_from(mm, pos)
+        pos += _AR_PCCOMPILED.size
+        tables = []
+        for _ in range(2):
+            numstrs = u32()
+            pos += _BC_U32.size
+            stridxs = struct.unpack_from('<%sI' % (numstrs,), mm, pos)
+            pos += _BC_U32.size * numstrs
+            tables.append([self._unicode(idx) for idx in stridxs])
+        literals, locals_ = tables
+        auxs = []
+        numauxs = u32()
+        pos += _BC_U32.size
+        for _ in xrange(numauxs):
+            auxtype, numvarlists = struct.unpack_from('<II', mm, pos)
+            pos += 2 * _BC_U32.size
+            auxdata = None
+            if numvarlists != _BC_NO_AUXDATA:
+                auxdata = []
+                for _ in xrange(numvarlists):
+                    numvars = u32()
+                    pos += _BC_U32.size
+                    auxdata.append(list(struct.unpack_from('<%sI' % (numvars,), mm, pos)))
+                    pos += _BC_U32.size * numvars
+            auxs.append((self._str(auxtype), auxdata))
+        bc = BC(bytecode, literals, locals_, auxs, _load_compiled(compiled))
+        bc.skip(pc)
+        bc._digest = binascii.hexlify(digest)
+        return bc
 
 ########################
 # Functions start here #
@@ -581,16 +1713,22 @@ def getinsts(bc):
     """
     Given bytecode in a bytearray, return a list of Inst objects.
     """
-    bc = bc.copy()
-    insts = []
-    while len(bc) > 0:
-        insts.append(Inst(bc))
-    return insts
+    return InstStream(bc).insts()
 
-def _bblock_create(insts):
+def _bblock_create(insts, starts=None):
     """
-    Given a list of Inst objects, split them up into basic blocks.
+    Given a list of Inst objects, split them up into basic blocks. If the
+    indexes of the instructions starting each block are already known (e.g.
+    the blockstarts of an InstStream) they can be passed as `starts`.
     """
+    if starts is not None:
+        ends = list(starts[1:]) + [len(insts)]
+        return [
+            BBlock(insts[start:end], insts[start].loc)
+            for start, end in zip(starts, ends)
+        ]
+    # Map instruction locations back to their index in the list
+    locidxs = dict([(inst.loc, i) for i, inst in enumerate(insts)])
     # Identify the beginnings and ends of all basic blocks
     starts = set()
     ends = set()
@@ -604,13 +1742,8 @@ def _bblock_create(insts):
             starts.add(inst.targetloc)
             newstart = True
             # inst before target inst is end of a bblock
-            # search through instructions for instruction before the target
             if inst.targetloc != 0:
-                instbeforeidx = 0
-                while True:
-                    if insts[instbeforeidx+1].loc == inst.targetloc: break
-                    instbeforeidx += 1
-                instbefore = insts[instbeforeidx]
+                instbefore = insts[locidxs[inst.targetloc]-1]
                 ends.add(instbefore.loc)
         elif inst.name in ['beginCatch4', 'endCatch']:
             starts.add(inst.loc)
@@ -620,15 +1753,14 @@ def _bblock_create(insts):
     # Create the basic blocks
     assert len(starts) == len(ends)
     bblocks = []
-    bblocks_insts = insts[:]
+    nextidx = 0
     for start, end in zip(sorted(list(starts)), sorted(list(ends))):
-        bbinsts = []
-        assert bblocks_insts[0].loc == start
-        while bblocks_insts[0].loc < end:
-            bbinsts.append(bblocks_insts.pop(0))
-        assert bblocks_insts[0].loc == end
-        bbinsts.append(bblocks_insts.pop(0))
-        bblocks.append(BBlock(bbinsts, bbinsts[0].loc))
+        startidx = locidxs[start]
+        endidx = locidxs[end]
+        assert startidx == nextidx and startidx <= endidx
+        bblocks.append(BBlock(insts[startidx:endidx+1], start))
+        nextidx = endidx + 1
+    assert nextidx == len(insts)
     return bblocks
 
 def _inst_reductions():
@@ -716,6 +1848,8 @@ def _inst_reductions():
     for inst, (getargsgen_args, redfn) in inst_reductions.items():
         inst_reductions[inst] = {
             'getargsfn': getargsgen(*getargsgen_args),
+            'nargsfn': getargsgen_args[0],
+            'checkargsfn': getargsgen_args[1] if len(getargsgen_args) > 1 else None,
             'redfn': redfn,
         }
     return inst_reductions
@@ -741,13 +1875,14 @@ def _bblock_hack(bc, bblock):
         changes.append((TAG_H_VARIABLE, (i+1, i+2), (i+1, i+1)))
     return bblock, changes
 
-def _bblock_reduce(bc, bblock):
+def _bblock_reduce(bc, bblock, starti=0):
     """
     For the given basic block, attempt to reduce all instructions to my higher
-    level representations.
+    level representations. Instructions before `starti` are assumed to already
+    be known to be irreducible.
     """
     changes = []
-    for i, inst in enumerate(bblock.insts):
+    for i, inst in enumerate(bblock.insts[starti:], starti):
         if not isinstance(inst, Inst): continue
 
         if inst.name in ['push1', 'push4']:
@@ -774,6 +1909,79 @@ def _bblock_reduce(bc, bblock):
 
     return bblock, changes
 
+def _bblock_reduce_stack(bc, bblock, starti=0):
+    """
+    For the given basic block, reduce all instructions to my higher level
+    representations in a single forward pass by keeping track of the values on
+    the Tcl stack. The result is the same as reducing with `_bblock_reduce`
+    until nothing changes, but is reported as a single change.
+    """
+    insts = bblock.insts
+    newinsts = list(insts[:starti])
+    # Indexes in newinsts of the values available to be taken as arguments.
+    # Arguments can't be taken from beyond anything that isn't a value (e.g. an
+    # unreduced instruction), so the stack is emptied when one is reached.
+    stack = []
+    for newi in reversed(range(len(newinsts))):
+        if not isinstance(newinsts[newi], BCValue): break
+        if newinsts[newi].stackn >= 1: stack.insert(0, newi)
+    firsti = None
+    for i, inst in enumerate(insts[starti:], starti):
+        redinsts = None
+        nargs = 0
+        if not isinstance(inst, Inst):
+            pass
+
+        elif inst.name in ['push1', 'push4']:
+            redinsts = [BCLiteral(inst, bc.literal(inst.ops[0]))]
+
+        elif inst.name in INST_REDUCTIONS:
+            IRED = INST_REDUCTIONS[inst.name]
+            nargs = IRED['nargsfn'](inst)
+            checkargsfn = IRED['checkargsfn']
+            redfn = IRED['redfn']
+            if nargs <= len(stack):
+                arglist = [newinsts[argi] for argi in stack[len(stack)-nargs:]]
+                if checkargsfn is None or all([checkargsfn(arg) for arg in arglist]):
+                    redinsts = redfn(inst, arglist)
+                    if type(redinsts) is not list:
+                        redinsts = [redinsts]
+
+        if redinsts is None:
+            redinsts = [inst]
+        else:
+            # Like _bblock_reduce, replace as many instructions as were taken
+            # as arguments from the end of the block
+            argstart = len(newinsts) - nargs
+            newinsts[argstart:] = []
+            while stack and stack[-1] >= argstart:
+                stack.pop()
+            firsti = argstart if firsti is None else min(firsti, argstart)
+        for redinst in redinsts:
+            if not isinstance(redinst, BCValue):
+                stack = []
+            elif redinst.stackn >= 1:
+                stack.append(len(newinsts))
+            newinsts.append(redinst)
+
+    if firsti is None:
+        return bblock, []
+    bblock = BBlock(newinsts, bblock.loc)
+    return bblock, [(TAG_I_STACK, (firsti, len(insts)), (firsti, len(newinsts)))]
+
+# The available ways of reducing instructions within a bblock
+REDUCE_ENGINES = {
+    # One instruction per step, showing every reduction in decompile_steps
+    'step': _bblock_reduce,
+    # All reducible instructions at once, simulating the stack
+    'stack': _bblock_reduce_stack,
+}
+
+# The jump targets are tracked in a Counter of target loc -> number of jumps,
+# built with _get_targets when decompilation starts. Reductions and bblock joins
+# never add or remove a jump (jumps always end a bblock, and bblocks ending in a
+# jump are never joined to the next), so only _bblock_flow has to update it
+# when it consumes jumps into a control structure.
 def _get_targets(bblocks):
     targets = [target for target in [
         (lambda jump: jump and jump.targetloc)(_get_jump(src_bblock))
@@ -800,150 +2008,220 @@ def _is_catch_end(bblock):
     if not isinstance(catch, Inst): return False
     return catch.name == 'endCatch'
 
-def _bblock_flow(bblocks):
-    # Recognise a basic if.
-    # Observe that we don't try and recognise a basic if with no else branch -
-    # it turns out that tcl implicitly inserts the else to provide all
-    # execution branches with a value. TODO: this is an implementation detail
-    # and should be handled more generically.
-    # The overall structure consists of 4 basic blocks, arranged like so:
-    # [if] -> [ifcode]  [elsecode] -> [unrelated code after if]
-    #   |---------|----------^          ^        <- conditional jump to else
-    #             |---------------------|        <- unconditional jump to end
-    # We only care about the end block for checking that everything does end up
-    # there. The other three blocks end up 'consumed' by a BCIf object.
-    for i in range(len(bblocks)):
-        if len(bblocks[i:i+4]) < 4:
-            continue
-        jump0 = _get_jump(bblocks[i+0])
-        jump1 = _get_jump(bblocks[i+1])
-        jump2 = _get_jump(bblocks[i+2])
-        if jump0 is None or jump0.on is None: continue
-        if jump1 is None or jump1.on is not None: continue
-        if jump2 is not None: continue
-        if jump0.targetloc != bblocks[i+2].loc: continue
-        if jump1.targetloc != bblocks[i+3].loc: continue
-        if any([
-                isinstance(inst, Inst) for inst in
-                bblocks[i+1].insts + bblocks[i+2].insts
-                ]):
-            continue
-        targets = _get_targets(bblocks)
-        if targets.count(bblocks[i+1].loc) > 0: continue
-        if targets.count(bblocks[i+2].loc) > 1: continue
-        # Looks like an 'if', apply the bblock transformation
-        changestart = ((i, 0), (i+2, len(bblocks[i+2].insts)))
-        jumps = [bblocks[i+0].insts[-1], bblocks[i+1].insts[-1]]
-        bblocks[i+0] = bblocks[i+0].popinst()
-        bblocks[i+1] = bblocks[i+1].popinst()
-        assert jumps == [jump0, jump1]
-        bblocks[i] = bblocks[i].appendinsts([BCIf(jumps, bblocks[i+1:i+3])])
-        bblocks[i+1:i+3] = []
-        changeend = ((i, 0), (i, len(bblocks[i].insts)))
-        return [(TAG_IF, changestart, changeend)]
-
-    # Recognise a catch
-    # The overall structure consists of 3 basic blocks, arranged like so:
-    # [beginCatch+code]   [oncatch]   [endCatch+unrelated code after catch]
-    #        |----------------------------^    <- unconditional jump to endCatch
-    # The oncatch block is a series of instructions for handling when the code
-    # throws an exception - note there is no direct execution path to them. We
-    # make a number of assertions about them in case the bytecode compiler ever
-    # does something unexpected with them. All blocks are 'consumed' and replaced
-    # with a single BCCatch.
-    # TODO: because we steal instructions from the endCatch block, the bblock 'loc'
-    # is no longer correct!
-    for i in range(len(bblocks)):
-        if len(bblocks[i:i+3]) < 3:
-            continue
-        begin = bblocks[i+0]
-        middle = bblocks[i+1]
-        end = bblocks[i+2]
-        if not _is_catch_begin(begin): continue
-        if not _is_catch_end(end): continue
-        assert not (_is_catch_end(begin) or _is_catch_begin(end))
-        assert not (_is_catch_end(middle) or _is_catch_begin(middle))
-        if any([isinstance(inst, Inst) for inst in begin.insts[1:]]):
-            continue
-        # Looks like a 'catch', apply the bblock transformation
-        changestart = ((i, 0), (i+2, 4))
-        endcatchinst = end.insts[0]
-        end = end.replaceinst(0, [])
-        endcatch = BBlock([endcatchinst], endcatchinst.loc)
-        if (len(end.insts) > 2 and
-                isinstance(end.insts[0], Inst) and
-                isinstance(end.insts[1], Inst) and
-                isinstance(end.insts[2], Inst) and
-                end.insts[0].name == 'reverse' and
-                end.insts[1].name == 'storeScalar1' and
-                end.insts[2].name == 'pop'
-            ):
-            endcatch = endcatch.appendinsts(list(end.insts[0:3]))
-            end = end.replaceinst((0, 3), [])
+def _untarget(targets, jump):
+    targets[jump.targetloc] -= 1
+    if targets[jump.targetloc] == 0:
+        del targets[jump.targetloc]
+
+BBlockCFG = namedtuple('BBlockCFG', ['succs', 'preds'])
+def _bblock_cfg(bblocks):
+    """
+    Build the control flow graph of the bblocks, as lists of the indexes of the
+    successors and predecessors of each bblock. A fallthrough is listed before a
+    jump target, and predecessors are in order of index.
+    """
+    locidxs = dict([(bblock.loc, i) for i, bblock in enumerate(bblocks)])
+    succs = []
+    for i, bblock in enumerate(bblocks):
+        jump = bblock.insts[-1] if len(bblock.insts) > 0 else None
+        if isinstance(jump, BCJump):
+            fallthrough = jump.on is not None
+        elif isinstance(jump, Inst) and jump.targetloc is not None:
+            fallthrough = jump.name not in ['jump1', 'jump4']
         else:
-            assert False
-        bccatch = BCCatch(None, [begin, middle, endcatch])
-        bblocks[i] = begin.replaceinst((0, len(begin.insts)), [bccatch])
-        bblocks[i+2] = end
-        bblocks[i+1:i+2] = []
-        changeend = ((i, 0), (i, len(bblocks[i].insts)))
-        return [(TAG_CATCH, changestart, changeend)]
-
-    # Recognise a foreach.
-    # The overall structure consists of 4 basic blocks, arranged like so:
-    # [unrelated code+fe start] -> [fe step]  [fe code] -> [unrelated code to fe]
-    #                        ^  |--------|-----------^   <- conditional jump to end
-    #                        |-----------|               <- unconditional jump to fe step
-    # We only care about the end block for checking that everything does end up
-    # there. The other three blocks end up 'consumed' by a BCForEach object.
-    # If possible, we try and consume the BCLiteral sitting in the first instruction of
-    # end, though it may already have been consumed by a return call.
-    for i in range(len(bblocks)):
-        if len(bblocks[i:i+4]) < 4:
-            continue
-        jump0 = _get_jump(bblocks[i+0])
-        jump1 = bblocks[i+1].insts[-1]
-        jump2 = _get_jump(bblocks[i+2])
-        if jump0 is not None: continue
-        # Unreduced because jumps don't know how to consume foreach_step
-        if not isinstance(jump1, Inst) or jump1.name != 'jumpFalse1': continue
-        if jump2 is None or jump2.on is not None: continue
-        if jump1.targetloc is not bblocks[i+3].loc: continue
-        if jump2.targetloc is not bblocks[i+1].loc: continue
-        if any([isinstance(inst, Inst) for inst in bblocks[i+2].insts]): continue
-        if not isinstance(bblocks[i+3].insts[0], BCLiteral): continue
-        targets = _get_targets(bblocks)
-        if targets.count(bblocks[i+1].loc) > 1: continue
-        if targets.count(bblocks[i+2].loc) > 0: continue
-        if targets.count(bblocks[i+3].loc) > 1: continue
-        # Looks like a 'foreach', apply the bblock transformation
-        changestart = ((i, len(bblocks[i].insts)-1), (i+3, 1))
-        foreach_start = bblocks[i].insts[-1]
+            jump = None
+            fallthrough = True
+        bbsuccs = []
+        if fallthrough and i+1 < len(bblocks):
+            bbsuccs.append(i+1)
+        if jump is not None and jump.targetloc in locidxs:
+            bbsuccs.append(locidxs[jump.targetloc])
+        succs.append(bbsuccs)
+    preds = [[] for _ in bblocks]
+    for i, bbsuccs in enumerate(succs):
+        for succ in bbsuccs:
+            preds[succ].append(i)
+    return BBlockCFG(succs, preds)
+
+# Recognise a basic if.
+# Observe that we don't try and recognise a basic if with no else branch -
+# it turns out that tcl implicitly inserts the else to provide all
+# execution branches with a value. TODO: this is an implementation detail
+# and should be handled more generically.
+# The overall structure consists of 4 basic blocks, arranged like so:
+# [if] -> [ifcode]  [elsecode] -> [unrelated code after if]
+#   |---------|----------^          ^        <- conditional jump to else
+#             |---------------------|        <- unconditional jump to end
+# We only care about the end block for checking that everything does end up
+# there. The other three blocks end up 'consumed' by a BCIf object.
+def _flow_match_if(bblocks, cfg, i):
+    if len(bblocks[i:i+4]) < 4:
+        return False
+    jump0 = _get_jump(bblocks[i+0])
+    jump1 = _get_jump(bblocks[i+1])
+    jump2 = _get_jump(bblocks[i+2])
+    if jump0 is None or jump0.on is None: return False
+    if jump1 is None or jump1.on is not None: return False
+    if jump2 is not None: return False
+    if cfg.succs[i] != [i+1, i+2]: return False
+    if cfg.succs[i+1] != [i+3]: return False
+    # The branches can't be entered from anywhere else
+    if cfg.preds[i+1] != [i] or cfg.preds[i+2] != [i]: return False
+    if any([
+            isinstance(inst, Inst) for inst in
+            bblocks[i+1].insts + bblocks[i+2].insts
+            ]):
+        return False
+    return True
+def _flow_if(bblocks, targets, i):
+    changestart = ((i, 0), (i+2, len(bblocks[i+2].insts)))
+    jumps = [bblocks[i+0].insts[-1], bblocks[i+1].insts[-1]]
+    bblocks[i+0] = bblocks[i+0].popinst()
+    bblocks[i+1] = bblocks[i+1].popinst()
+    for jump in jumps:
+        _untarget(targets, jump)
+    bblocks[i] = bblocks[i].appendinsts([BCIf(jumps, bblocks[i+1:i+3])])
+    bblocks[i+1:i+3] = []
+    changeend = ((i, 0), (i, len(bblocks[i].insts)))
+    return [(TAG_IF, changestart, changeend)]
+
+# Recognise a catch
+# The overall structure consists of 3 basic blocks, arranged like so:
+# [beginCatch+code]   [oncatch]   [endCatch+unrelated code after catch]
+#        |----------------------------^    <- unconditional jump to endCatch
+# The oncatch block is a series of instructions for handling when the code
+# throws an exception - note there is no direct execution path to them. We
+# make a number of assertions about them in case the bytecode compiler ever
+# does something unexpected with them. All blocks are 'consumed' and replaced
+# with a single BCCatch.
+# TODO: because we steal instructions from the endCatch block, the bblock 'loc'
+# is no longer correct!
+def _flow_match_catch(bblocks, cfg, i):
+    if len(bblocks[i:i+3]) < 3:
+        return False
+    begin = bblocks[i+0]
+    middle = bblocks[i+1]
+    end = bblocks[i+2]
+    if not _is_catch_begin(begin): return False
+    if not _is_catch_end(end): return False
+    assert not (_is_catch_end(begin) or _is_catch_begin(end))
+    assert not (_is_catch_end(middle) or _is_catch_begin(middle))
+    if any([isinstance(inst, Inst) for inst in begin.insts[1:]]):
+        return False
+    return True
+def _flow_catch(bblocks, targets, i):
+    begin = bblocks[i+0]
+    middle = bblocks[i+1]
+    end = bblocks[i+2]
+    changestart = ((i, 0), (i+2, 4))
+    endcatchinst = end.insts[0]
+    end = end.replaceinst(0, [])
+    endcatch = BBlock([endcatchinst], endcatchinst.loc)
+    if (len(end.insts) > 2 and
+            isinstance(end.insts[0], Inst) and
+            isinstance(end.insts[1], Inst) and
+            isinstance(end.insts[2], Inst) and
+            end.insts[0].name == 'reverse' and
+            end.insts[1].name == 'storeScalar1' and
+            end.insts[2].name == 'pop'
+        ):
+        endcatch = endcatch.appendinsts(list(end.insts[0:3]))
+        end = end.replaceinst((0, 3), [])
+    else:
+        assert False
+    bccatch = BCCatch(None, [begin, middle, endcatch])
+    _untarget(targets, _get_jump(begin))
+    bblocks[i] = begin.replaceinst((0, len(begin.insts)), [bccatch])
+    bblocks[i+2] = end
+    bblocks[i+1:i+2] = []
+    changeend = ((i, 0), (i, len(bblocks[i].insts)))
+    return [(TAG_CATCH, changestart, changeend)]
+
+# Recognise a foreach.
+# The overall structure consists of 4 basic blocks, arranged like so:
+# [unrelated code+fe start] -> [fe step]  [fe code] -> [unrelated code to fe]
+#                        ^  |--------|-----------^   <- conditional jump to end
+#                        |-----------|               <- unconditional jump to fe step
+# We only care about the end block for checking that everything does end up
+# there. The other three blocks end up 'consumed' by a BCForEach object.
+# If possible, we try and consume the BCLiteral sitting in the first instruction of
+# end, though it may already have been consumed by a return call.
+def _flow_match_foreach(bblocks, cfg, i):
+    if len(bblocks[i:i+4]) < 4:
+        return False
+    if len(bblocks[i+1].insts) == 0 or len(bblocks[i+3].insts) == 0:
+        return False
+    jump0 = _get_jump(bblocks[i+0])
+    jump1 = bblocks[i+1].insts[-1]
+    jump2 = _get_jump(bblocks[i+2])
+    if jump0 is not None: return False
+    # Unreduced because jumps don't know how to consume foreach_step
+    if not isinstance(jump1, Inst) or jump1.name != 'jumpFalse1': return False
+    if jump2 is None or jump2.on is not None: return False
+    if cfg.succs[i+1] != [i+2, i+3]: return False
+    if cfg.succs[i+2] != [i+1]: return False
+    if any([isinstance(inst, Inst) for inst in bblocks[i+2].insts]): return False
+    if not isinstance(bblocks[i+3].insts[0], BCLiteral): return False
+    # The loop can only be entered at the start and left at the end
+    if cfg.preds[i+1] != [i, i+2]: return False
+    if cfg.preds[i+2] != [i+1]: return False
+    if cfg.preds[i+3] != [i+1]: return False
+    return True
+def _flow_foreach(bblocks, targets, i):
+    changestart = ((i, len(bblocks[i].insts)-1), (i+3, 1))
+    foreach_start = bblocks[i].insts[-1]
+    _untarget(targets, bblocks[i+1].insts[-1])
+    _untarget(targets, bblocks[i+2].insts[-1])
+    bblocks[i] = bblocks[i].popinst()
+    numvarlists = len(foreach_start.ops[0][1])
+    varlists = []
+    for i in range(numvarlists):
+        varlists.append(bblocks[i].insts[-1])
         bblocks[i] = bblocks[i].popinst()
-        numvarlists = len(foreach_start.ops[0][1])
-        varlists = []
-        for i in range(numvarlists):
-            varlists.append(bblocks[i].insts[-1])
-            bblocks[i] = bblocks[i].popinst()
-        # TODO: Location isn't actually correct...do we care?
-        begin = BBlock(varlists + [foreach_start], foreach_start.loc)
-        end = bblocks[i+3].insts[0]
-        bblocks[i+3] = bblocks[i+3].replaceinst(0, [])
-        foreach = BCForeach(None, [begin] + bblocks[i+1:i+3] + [end])
-        bblocks[i] = bblocks[i].appendinsts([foreach])
-        bblocks[i+1:i+3] = []
-        changeend = ((i, len(bblocks[i].insts)-1), (i, len(bblocks[i].insts)))
-        return [(TAG_FOREACH, changestart, changeend)]
-
+    # TODO: Location isn't actually correct...do we care?
+    begin = BBlock(varlists + [foreach_start], foreach_start.loc)
+    end = bblocks[i+3].insts[0]
+    bblocks[i+3] = bblocks[i+3].replaceinst(0, [])
+    foreach = BCForeach(None, [begin] + bblocks[i+1:i+3] + [end])
+    bblocks[i] = bblocks[i].appendinsts([foreach])
+    bblocks[i+1:i+3] = []
+    changeend = ((i, len(bblocks[i].insts)-1), (i, len(bblocks[i].insts)))
+    return [(TAG_FOREACH, changestart, changeend)]
+
+def _bblock_flow(bblocks, targets):
+    """
+    Recognise a control structure in the bblocks and replace it with a single
+    instruction. To keep a predictable order of changes, the first if is
+    preferred, then the first catch, then the first foreach.
+
+    Each call builds the control flow graph and looks for all kinds of
+    structure in one scan from the first bblock, so it's O(bblocks). Only one
+    structure is replaced per call (each is its own step of decompilation), so
+    recognising them all is still O(bblocks * structures) - the single scan
+    only saves a constant factor over a scan per kind.
+    """
+    cfg = _bblock_cfg(bblocks)
+    catchi = None
+    foreachi = None
+    for i in range(len(bblocks)):
+        if _flow_match_if(bblocks, cfg, i):
+            return _flow_if(bblocks, targets, i)
+        if catchi is None and _flow_match_catch(bblocks, cfg, i):
+            catchi = i
+        if foreachi is None and _flow_match_foreach(bblocks, cfg, i):
+            foreachi = i
+    if catchi is not None:
+        return _flow_catch(bblocks, targets, catchi)
+    if foreachi is not None:
+        return _flow_foreach(bblocks, targets, foreachi)
     return []
 
-def _bblock_join(bblocks):
+def _bblock_join(bblocks, targets, joinfrom=0):
 
     # Remove empty unused blocks
     # TODO: unknown if this is needed
     for i, bblock in enumerate(bblocks):
         if len(bblock.insts) > 0: continue
-        targets = _get_targets(bblocks)
         if bblock.loc in targets: continue
         bblocks[i:i+1] = []
 
@@ -952,11 +2230,10 @@ def _bblock_join(bblocks):
         return [(TAG_BLOCK_RM, ((i, 0), (i, 0)), ((previ, previlen), (previ, previlen)))]
 
     # Join together blocks if possible
-    for i in range(len(bblocks)):
+    for i in range(joinfrom, len(bblocks)):
         if len(bblocks[i:i+2]) < 2:
             continue
         bblock1, bblock2 = bblocks[i:i+2]
-        targets = _get_targets(bblocks)
         # If the end of bblock1 or the beginning of bblock2 should remain as
         # bblock boundaries, do not join them.
         if _get_jump(bblock1) is not None:
@@ -972,7 +2249,7 @@ def _bblock_join(bblocks):
         if _is_catch_end(bblock2):
             continue
         changestart = ((i, 0), (i+1, len(bblocks[i+1].insts)))
-        bblocks[i] = bblock1.appendinsts(list(bblock2.insts))
+        bblocks[i] = bblock1.appendinsts(bblock2.insts)
         bblocks[i+1:i+2] = []
         changeend = ((i, 0), (i, len(bblocks[i].insts)))
         return [(TAG_BLOCK_JOIN, changestart, changeend)]
@@ -995,13 +2272,42 @@ def _bblocks_operation(bblock_op, bc, bblocks):
         ])
     return operbblocks, operchanges
 
-def _decompile(bc):
+def _bblocks_reduce(bc, bblocks, reducefrom, bblock_reduce=_bblock_reduce):
+    """
+    Equivalent to `_bblocks_operation(bblock_reduce, bc, bblocks)`, but only
+    revisits what may have changed. A reduction only rewrites instructions from
+    the start of its arguments onwards and whether an instruction can be reduced
+    only depends on the instructions before it, so each bblock resumes scanning
+    where it was last reduced. `reducefrom` maps each bblock to that index, or
+    None if the bblock is fully reduced, and is updated for the new bblocks.
+    """
+    redbblocks = []
+    redchanges = []
+    newreducefrom = {}
+    for bbi, bblock in enumerate(bblocks):
+        starti = reducefrom.get(bblock, 0)
+        if starti is not None:
+            bblock, bblockchanges = bblock_reduce(bc, bblock, starti)
+            starti = None
+            for tag, (lfrom1, lfrom2), (lto1, lto2) in bblockchanges:
+                starti = lfrom1
+                redchanges.append(
+                    (tag, ((bbi, lfrom1), (bbi, lfrom2)), ((bbi, lto1), (bbi, lto2)))
+                )
+        redbblocks.append(bblock)
+        newreducefrom[bblock] = starti
+    reducefrom.clear()
+    reducefrom.update(newreducefrom)
+    return redbblocks, redchanges
+
+def _decompile(bc, engine='step'):
     """
     Given some bytecode and literals, attempt to decompile to tcl.
     """
     assert isinstance(bc, BC)
-    insts = getinsts(bc)
-    bblocks = _bblock_create(insts)
+    bblock_reduce = REDUCE_ENGINES[engine]
+    stream = InstStream(bc)
+    bblocks = _bblock_create(stream.insts(), stream.blockstarts)
     yield bblocks[:], []
 
     # Reduce bblock logic
@@ -1009,35 +2315,106 @@ def _decompile(bc):
     if changes:
         bblocks = hackedbblocks
         yield bblocks[:], changes
-
+    targets = Counter(_get_targets(bblocks))
+
+    # Rather than re-examining everything after each change, keep track of the
+    # work that can be skipped. See _bblocks_reduce for reductions. For joins,
+    # no pair of bblocks before joinfrom can be joined - this holds until a
+    # bblock in that range changes or the set of jump targets does (which only
+    # happens on control flow recognition).
+    reducefrom = {}
+    joinfrom = 0
     changes = True
     while changes:
         changes = []
         if not changes:
-            bblocks, changes = _bblocks_operation(_bblock_reduce, bc, bblocks)
+            bblocks, changes = _bblocks_reduce(bc, bblocks, reducefrom, bblock_reduce)
+            for _, ((bbi, _), _), _ in changes:
+                joinfrom = min(joinfrom, max(0, bbi-1))
         if not changes:
-            changes = _bblock_join(bblocks)
+            changes = _bblock_join(bblocks, targets, joinfrom)
+            if changes:
+                tag, ((bbi, _), _), _ = changes[0]
+                # A join is of the first joinable pair from joinfrom, but an
+                # empty bblock can be removed from anywhere, leaving the pairs
+                # before it unchecked
+                if tag == TAG_BLOCK_JOIN:
+                    joinfrom = max(0, bbi-1)
+                else:
+                    joinfrom = min(joinfrom, max(0, bbi-1))
         if not changes:
-            changes = _bblock_flow(bblocks)
+            changes = _bblock_flow(bblocks, targets)
+            joinfrom = 0
         if changes: yield bblocks[:], changes
 
-def _bblocks_fmt(bblocks):
-    outstr = ''
-    for bblock in bblocks:
-        #outstr += '===========%s\n' % (bblock)
-        outstr += bblock.fmt()
-        outstr += '\n'
-    return outstr
+def _bblocks_lines(bblocks):
+    # This owns bblocks, and lets go of each bblock as it's reached so that
+    # what's been rendered can be freed
+    for bbi in xrange(len(bblocks)):
+        bblock = bblocks[bbi]
+        bblocks[bbi] = None
+        #yield '===========%s\n' % (bblock)
+        if len(bblock.insts) == 0:
+            yield u'\n'
+            continue
+        # Each top level command is rendered on its own (and its text isn't
+        # kept), so only one is ever held in memory at a time
+        for inst in bblock.insts:
+            out = Writer()
+            bblock.writeinst(out, inst)
+            out.write(u'\n')
+            yield out.getvalue()
+
+def decompile(bc, engine='step'):
+    """
+    Given some bytecode, returns a string of the decompiled Tcl.
+
+    `engine` is one of the keys of `REDUCE_ENGINES`. The engines give the same
+    result, but 'stack' gets there in fewer steps.
+    """
+    return _cached('decompile', bc, engine,
+        lambda: u''.join(iter_decompile_lines(bc, engine)),
+        sys.getsizeof
+    )
+
+def iter_decompile_lines(bc, engine='step'):
+    """
+    Given some bytecode, yields the decompiled Tcl as it is rendered, one
+    'line' at a time. `engine` is as for `decompile`.
+
+    As in `decompile_steps`, a line is a single top level command (which may
+    itself span several lines, e.g. an `if`). Each line ends with a newline and
+    joining them all gives the same string as `decompile`.
 
-def decompile(bc):
+    This doesn't use the cache (see `enable_cache`) - the bytecode is
+    decompiled on every call.
+    """
     bblocks = None
-    for bblocks, _ in _decompile(bc):
+    for bblocks, _ in _decompile(bc, engine):
         pass
-    return _bblocks_fmt(bblocks)
+    return _bblocks_lines(bblocks)
+
+def decompile_to(bc, fileobj, engine='step'):
+    """
+    Given some bytecode, writes the decompiled Tcl to `fileobj` as it is
+    rendered, rather than building the whole string first. `engine` is as for
+    `decompile`.
+
+    `fileobj` is written with unicode strings, e.g. a file from `io.open`.
+
+    If caching is enabled (see `enable_cache`), this goes through the cache as
+    `decompile` does, so the whole string is built and kept.
+    """
+    if _cache is not None:
+        fileobj.write(decompile(bc, engine))
+        return
+    for line in iter_decompile_lines(bc, engine):
+        fileobj.write(line)
 
-def decompile_steps(bc):
+def decompile_steps(bc, engine='step'):
     """
     Given some bytecode, returns a tuple of `(steps, changes)` for decompilation.
+    `engine` is as for `decompile`.
 
     `steps` is a list of 'snapshot's of each stage of the decompilation.
     Each 'snapshot' is a list of 'basic block's in the program in that snapshot.
@@ -1069,19 +2446,321 @@ def decompile_steps(bc):
     are the same, it means the source lines have been reduced to a line of
     width 0 (i.e. have been removed entirely).
     """
-    steps = []
-    changes = []
-    for si, (sbblocks, schanges) in enumerate(_decompile(bc)):
-        step = []
-        for sbblock in sbblocks:
-            step.append(sbblock.fmt_insts())
-        for schange in schanges:
-            tag, lfrom, lto = schange
-            changes.append({
-                'step': si-1,
-                'from': lfrom,
-                'to': lto,
-                'tag': tag,
-            })
-        steps.append(step)
+    def decompile_steps_uncached():
+        steps = []
+        changes = []
+        for step, stepchanges in iter_decompile_steps(bc, engine):
+            steps.append(step)
+            changes.extend(stepchanges)
+        return steps, changes
+    steps, changes = _cached('decompile_steps', bc, engine,
+        decompile_steps_uncached, _steps_size
+    )
+    if _cache is not None:
+        # Callers are free to modify what they get back, so don't give them
+        # what's in the cache
+        steps = [[list(lines) for lines in step] for step in steps]
+        changes = [dict(change) for change in changes]
     return steps, changes
+
+def _steps_size(result):
+    steps, changes = result
+    size = sys.getsizeof(steps) + sys.getsizeof(changes)
+    for step in steps:
+        size += sys.getsizeof(step)
+        for lines in step:
+            size += sys.getsizeof(lines) + sum([sys.getsizeof(line) for line in lines])
+    return size + sum([sys.getsizeof(change) for change in changes])
+
+def iter_decompile_steps(bc, engine='step'):
+    """
+    Given some bytecode, yields a tuple of `(step, changes)` for each step of
+    decompilation as soon as it has been made, rather than waiting for the
+    whole decompilation to finish. `engine` is as for `decompile`.
+
+    `step` is a 'snapshot' and `changes` is a list of the 'change descriptor's
+    which produced it from the previous step, both as described for
+    `decompile_steps`. The changes for the first step are always empty.
+    """
+    for si, (sbblocks, schanges) in enumerate(_decompile(bc, engine)):
+        step = [sbblock.fmt_insts() for sbblock in sbblocks]
+        yield step, _step_changes(si, schanges)
+
+def _step_changes(si, schanges):
+    return [{
+        'step': si-1,
+        'from': lfrom,
+        'to': lto,
+        'tag': tag,
+    } for tag, lfrom, lto in schanges]
+
+# Consecutive snapshots from _decompile share every bblock and instruction that
+# wasn't touched (they're all immutable), so the lines that differ between two
+# steps can be found by identity without formatting anything. A snapshot is
+# treated as a flat sequence of instructions with a separator between each
+# bblock, and the delta is the span left after trimming the common prefix and
+# suffix. Reductions only ever change bblocks in place, so when the number of
+# bblocks is the same each changed one is diffed separately.
+
+def _common_prefix(bblocks1, bblocks2, rev=False):
+    order = reversed if rev else iter
+    n = 0
+    for bblock1, bblock2 in itertools.izip(order(bblocks1), order(bblocks2)):
+        if bblock1 is bblock2:
+            n += len(bblock1.insts) + 1
+            continue
+        ninsts = 0
+        for inst1, inst2 in itertools.izip(order(bblock1.insts), order(bblock2.insts)):
+            if inst1 is not inst2: break
+            ninsts += 1
+        n += ninsts
+        if not ninsts == len(bblock1.insts) == len(bblock2.insts):
+            break
+        n += 1 # separator
+    return n
+
+def _flat_len(bblocks):
+    return sum([len(bblock.insts) for bblock in bblocks]) + len(bblocks) - 1
+
+def _flat_pos(bblocks, n):
+    for bbi, bblock in enumerate(bblocks):
+        if n <= len(bblock.insts):
+            return bbi, n
+        n -= len(bblock.insts) + 1
+    assert False
+
+def _step_hunk(prevbblocks, bblocks, bboffset=0):
+    prevlen = _flat_len(prevbblocks)
+    curlen = _flat_len(bblocks)
+    maxcommon = min(prevlen, curlen)
+    prefix = min(_common_prefix(prevbblocks, bblocks), maxcommon)
+    suffix = min(_common_prefix(prevbblocks, bblocks, rev=True), maxcommon - prefix)
+    bbfrom1, lfrom1 = _flat_pos(prevbblocks, prefix)
+    bbfrom2, lfrom2 = _flat_pos(prevbblocks, prevlen - suffix)
+    bbto1, lto1 = _flat_pos(bblocks, prefix)
+    bbto2, lto2 = _flat_pos(bblocks, curlen - suffix)
+    if bbto1 == bbto2:
+        lines = [bblocks[bbto1].fmt_insts(lto1, lto2)]
+    else:
+        lines = (
+            [bblocks[bbto1].fmt_insts(lto1)] +
+            [bblock.fmt_insts() for bblock in bblocks[bbto1+1:bbto2]] +
+            [bblocks[bbto2].fmt_insts(0, lto2)]
+        )
+    return {
+        'from': ((bboffset+bbfrom1, lfrom1), (bboffset+bbfrom2, lfrom2)),
+        'lines': lines,
+    }
+
+def _step_delta(prevbblocks, bblocks):
+    if len(prevbblocks) != len(bblocks):
+        return [_step_hunk(prevbblocks, bblocks)]
+    return [
+        _step_hunk([prevbblock], [bblock], bbi)
+        for bbi, (prevbblock, bblock) in enumerate(zip(prevbblocks, bblocks))
+        if prevbblock is not bblock
+    ]
+
+def decompile_step_deltas(bc, engine='step'):
+    """
+    Given some bytecode, returns a tuple of `(first, deltas, changes)`. This is
+    the same information as `decompile_steps` but only the lines which change
+    are stored for each step. `engine` is as for `decompile`.
+
+    `first` is the first snapshot, as in `steps[0]` of `decompile_steps`.
+
+    `deltas` is a list of 'delta's, where `deltas[si]` turns step si into step
+    si+1. Each delta is a list of non-overlapping 'hunk's in order of position,
+    and each hunk looks like
+    {
+        'from':  ((bbfrom1, lfrom1), (bbfrom2, lfrom2)),
+        'lines': lines,
+    }
+     - bbfrom1, lfrom1, bbfrom2, lfrom2 are the slice indexes of the lines
+       being replaced in step si, as in the `decompile_steps` change
+       descriptors
+     - lines   is a list of 'basic block's (each a list of strings) to put in
+       their place. The first is joined to the start of block bbfrom1 (before
+       lfrom1), the last is joined to the end of block bbfrom2 (after lfrom2)
+       and any others are new blocks in between.
+
+    `changes` is exactly as for `decompile_steps`.
+
+    Use `rebuild_step` to get any complete step.
+    """
+    first = None
+    deltas = []
+    changes = []
+    prevbblocks = None
+    for si, (sbblocks, schanges) in enumerate(_decompile(bc, engine)):
+        if prevbblocks is None:
+            first = [sbblock.fmt_insts() for sbblock in sbblocks]
+        else:
+            deltas.append(_step_delta(prevbblocks, sbblocks))
+        changes.extend(_step_changes(si, schanges))
+        prevbblocks = sbblocks
+    return first, deltas, changes
+
+def rebuild_step(first, deltas, si):
+    """
+    Given the `first` snapshot and `deltas` from `decompile_step_deltas`,
+    returns step si as it would be in the `steps` of `decompile_steps`.
+    """
+    step = first
+    for delta in deltas[:si]:
+        step = list(step)
+        # Go backwards so earlier hunks' indexes are still valid
+        for hunk in reversed(delta):
+            (bbfrom1, lfrom1), (bbfrom2, lfrom2) = hunk['from']
+            lines = [list(bblocklines) for bblocklines in hunk['lines']]
+            lines[0][:0] = step[bbfrom1][:lfrom1]
+            lines[-1].extend(step[bbfrom2][lfrom2:])
+            step[bbfrom1:bbfrom2+1] = lines
+    return step
+
+def _decompile_worker(args):
+    name, bctables, engine = args
+    return name, decompile(BC(*bctables), engine)
+
+def iter_decompile_all(pattern='::*', workers=None, engine='step'):
+    """
+    Decompiles every proc in the interpreter with a fully qualified name
+    matching the glob `pattern` (as for Tcl's `string match`), yielding tuples
+    of `(name, decompiled)` in whatever order they finish. `engine` is as for
+    `decompile`.
+
+    Bytecode is extracted here, but decompiling is spread across a pool of
+    `workers` processes - by default one per CPU. If `workers` is 1, all the
+    work is done in this process. An exception from decompiling any proc is
+    raised here.
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    assert workers > 0
+    # Only the matching procs are compiled
+    bcs = getbc_namespace('::', recursive=True, pattern=pattern)
+    tasks = [
+        (name, (bc._bytecode, bc._literals, bc._locals, bc._auxs), engine)
+        for name, bc in bcs.iteritems()
+    ]
+    del bcs
+    if workers == 1:
+        for task in tasks:
+            yield _decompile_worker(task)
+        return
+    pool = multiprocessing.Pool(workers)
+    try:
+        # Big enough chunks to amortise the IPC, small enough to share the
+        # occasional huge proc out evenly
+        chunksize = max(1, len(tasks) // (workers * 8))
+        for result in pool.imap_unordered(_decompile_worker, tasks, chunksize):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def decompile_all(pattern='::*', workers=None, engine='step'):
+    """
+    As for `iter_decompile_all`, but returns a dict of fully qualified proc
+    name to decompiled Tcl once everything is done.
+    """
+    return dict(iter_decompile_all(pattern, workers, engine))
+
+_cache = None
+
+def _cached(kind, bc, engine, fn, sizefn):
+    if _cache is None:
+        return fn()
+    # A BC that's been skipped into decompiles differently from the whole
+    key = (kind, engine, bc.digest(), bc.pc())
+    result = _cache.get(key)
+    if result is None:
+        result = fn()
+        _cache.put(key, result, sizefn(result))
+    return result
+
+def enable_cache(maxentries=1024, maxbytes=64*1024*1024):
+    """
+    Starts caching the results of `decompile` (also used by `decompile_to`)
+    and `decompile_steps` in memory, keyed by the content of the bytecode (see
+    `BC.digest`) and where in it decompilation starts (see `BC.pc`). Any
+    previous cache is thrown away.
+    Returns the new `DecompileCache`.
+    """
+    global _cache
+    _cache = DecompileCache(maxentries, maxbytes)
+    return _cache
+
+def enable_disk_cache(path, maxbytes=1024*1024*1024):
+    """
+    As for `enable_cache`, but results are kept in the sqlite database at
+    `path` (created if it doesn't exist) so they can be reused by other
+    processes, including later runs. `maxbytes` limits the size of the results
+    in the database.
+    Returns the new `DiskCache`.
+    """
+    global _cache
+    _cache = DiskCache(path, maxbytes)
+    return _cache
+
+def disable_cache():
+    """
+    Stops caching decompilation results and throws away the cache.
+    """
+    global _cache
+    _cache = None
+
+def cache_stats():
+    """
+    Returns a dict of `hits`, `misses`, `entries` and `bytes` for the cache, or
+    None if caching isn't enabled.
+    """
+    if _cache is None:
+        return None
+    return _cache.stats()
+
+def write_archive(path, bcs):
+    """
+    Writes a `BCArchive` to `path` from a dict of name -> `BC` (e.g. from
+    `getbc_namespace`) or an iterable of name, `BC` pairs.
+    """
+    if isinstance(bcs, dict):
+        bcs = bcs.iteritems()
+    with BCArchiveWriter(path) as writer:
+        for name, bc in bcs:
+            writer.add(name, bc)
+
+def main(argv=None):
+    """
+    Command line interface for inspecting and pruning a disk cache.
+    """
+    parser = argparse.ArgumentParser(prog='tcldis')
+    subparsers = parser.add_subparsers(dest='command')
+    statsparser = subparsers.add_parser('cache-stats',
+        help='show the number and size of entries in a disk cache')
+    statsparser.add_argument('path')
+    pruneparser = subparsers.add_parser('cache-prune',
+        help='evict entries from a disk cache')
+    pruneparser.add_argument('path')
+    pruneparser.add_argument('--maxbytes', type=int,
+        help='evict least recently used entries down to this size')
+    pruneparser.add_argument('--stale', action='store_true',
+        help='evict entries from other versions of tcldis or Tcl')
+    pruneparser.add_argument('--all', action='store_true',
+        help='evict everything')
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.path):
+        parser.error('no cache at %s' % (args.path,))
+    cache = DiskCache(args.path)
+    if args.command == 'cache-prune':
+        if args.all:
+            cache.clear()
+        else:
+            cache.prune(args.maxbytes, args.stale)
+    stats = cache.stats()
+    print('%s entries, %s bytes' % (stats['entries'], stats['bytes']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+from __future__ import print_function
+
+import tclpy
+import tcldis
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import cPickle as pickle
+
+# Timings of things that need to stay fast on big procs. Run all benchmarks
+# with no arguments, or give the names of the ones to run.
+
+def bigproc(n):
+    """
+    Define a proc with n groups of commands, returning its BC.
+    """
+    body = []
+    for i in range(n):
+        body.append('set x%s [expr {$a > %s}]' % (i, i))
+        body.append('if {$x%s} {\n\tputs a%s\n} else {\n\tputs b\n}' % (i, i))
+        body.append('catch {foo %s} msg' % (i,))
+    tclpy.eval('proc bigproc {a} {\n%s\n}' % ('\n'.join(body),))
+    return tcldis.getbc(proc_name='bigproc')
+
+def timeit(fn, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def bench_pickle():
+    bc = bigproc(500)
+    insts = tcldis.getinsts(bc)
+    bblocks = None
+    for bblocks, _ in tcldis._decompile(bc, 'stack'):
+        pass
+    for name, obj in [('BC', bc), ('insts', insts), ('bblocks', bblocks)]:
+        for protocol in [0, pickle.HIGHEST_PROTOCOL]:
+            data = pickle.dumps(obj, protocol)
+            elapsed = timeit(lambda: pickle.loads(pickle.dumps(obj, protocol)))
+            print('pickle %-8s protocol %s: %9s bytes, round trip %.3fs' % (
+                name, protocol, len(data), elapsed
+            ))
+
+def bench_buffer():
+    bigproc(2000)
+    for enable in [False, True]:
+        tcldis.bytecode_buffer(enable)
+        bc = tcldis.getbc(proc_name='bigproc')
+        elapsed = timeit(lambda: tcldis.getbc(proc_name='bigproc'))
+        print('getbc %-10s %9s bytes of bytecode: %.5fs' % (
+            type(bc._bytecode).__name__, len(bc._bytecode), elapsed
+        ))
+    tcldis.bytecode_buffer(False)
+
+def bench_decode():
+    bc = bigproc(2000)
+    print('decode %s bytes: python %.3fs, C %.4fs' % (
+        len(bc),
+        timeit(lambda: tcldis._decode_py(bc)),
+        timeit(lambda: tcldis.InstStream(bc)),
+    ))
+    def pygetinsts():
+        pybc = bc.copy()
+        insts = []
+        while len(pybc) > 0:
+            insts.append(tcldis.Inst(pybc))
+        return insts
+    print('getinsts %s bytes: python %.3fs, C %.3fs' % (
+        len(bc), timeit(pygetinsts), timeit(lambda: tcldis.getinsts(bc)),
+    ))
+    stream = tcldis.InstStream(bc)
+    insts = stream.insts()
+    print('bblock_create %s insts: scanning %.3fs, from blockstarts %.3fs' % (
+        len(insts),
+        timeit(lambda: tcldis._bblock_create(insts)),
+        timeit(lambda: tcldis._bblock_create(insts, stream.blockstarts)),
+    ))
+
+def bench_archive():
+    n = 20000
+    tclpy.eval('namespace eval archive {}')
+    for i in range(n):
+        tclpy.eval(
+            'proc archive::p%s {a} {if {$a > %s} { puts common%s } else { return shared }}'
+            % (i, i, i)
+        )
+    bcs = tcldis.getbc_namespace('::archive')
+    names = random.sample(sorted(bcs), 100)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        picklepath = os.path.join(tmpdir, 'pickle')
+        archivepath = os.path.join(tmpdir, 'archive')
+        with open(picklepath, 'wb') as f:
+            pickle.dump(bcs, f, pickle.HIGHEST_PROTOCOL)
+        tcldis.write_archive(archivepath, bcs)
+        def frompickle():
+            with open(picklepath, 'rb') as f:
+                loaded = pickle.load(f)
+            return [loaded[name] for name in names]
+        def fromarchive():
+            with tcldis.BCArchive(archivepath) as archive:
+                return [archive[name] for name in names]
+        for kind, path, fn in [
+                ('pickle', picklepath, frompickle),
+                ('archive', archivepath, fromarchive)]:
+            print('%s procs, 100 lookups: %-7s %9s bytes, %.3fs' % (
+                n, kind, os.path.getsize(path), timeit(fn)
+            ))
+    finally:
+        shutil.rmtree(tmpdir)
+
+BENCHMARKS = {
+    'archive': bench_archive,
+    'buffer': bench_buffer,
+    'decode': bench_decode,
+    'pickle': bench_pickle,
+}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
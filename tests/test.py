@@ -1,6 +1,15 @@
 import tclpy
 import tcldis
 import unittest
+import io
+import os
+import shutil
+import tempfile
+import threading
+import cPickle as pickle
+import random
+import subprocess
+import sys
 
 from textwrap import dedent
 
@@ -103,6 +112,29 @@ if {$a} {
 \tputs c
 }
 ''')) # **
+# An empty bblock is removed after earlier blocks have been joined
+cases.append(('if_else_catch_after_ifs', u'''\
+if {$a} {
+\tif {$b} {
+\t\tset c 1
+\t} else {
+\t\tset c 2
+\t}
+}
+if {$b} {
+\tif {$a} {
+\t\tset c 3
+\t}
+} else {
+\tset c 4
+}
+if {$b} {
+\tset c 64
+} else {
+\tcatch {foo $a} msg
+}
+incr c
+''')) # **
 
 # ----------
 
@@ -150,26 +182,591 @@ def checkDecompileStepStructure(self, steps, changes):
     for bblock in steps[-1]:
         self.assertGreater(len(bblock), 0)
 
+def checkStepDeltas(self, bc, engine):
+    steps, changes = tcldis.decompile_steps(bc, engine)
+    first, deltas, dchanges = tcldis.decompile_step_deltas(bc, engine)
+    self.assertEqual(changes, dchanges)
+    self.assertEqual(len(deltas), len(steps) - 1)
+    for si, step in enumerate(steps):
+        self.assertEqual(tcldis.rebuild_step(first, deltas, si), step)
+    stepiter = tcldis.iter_decompile_steps(bc, engine)
+    self.assertEqual(next(stepiter), (steps[0], []))
+
+def checkPickle(self, bc):
+    for protocol in [0, pickle.HIGHEST_PROTOCOL]:
+        roundtrip = lambda obj: pickle.loads(pickle.dumps(obj, protocol))
+        self.assertEqual(repr(roundtrip(bc)), repr(bc))
+        insts = tcldis.getinsts(bc)
+        self.assertEqual(roundtrip(insts), insts)
+        for bblocks, _ in tcldis._decompile(bc):
+            self.assertEqual(
+                [bblock.fmt() for bblock in roundtrip(bblocks)],
+                [bblock.fmt() for bblock in bblocks]
+            )
+
+def checkInstStream(self, bc):
+
+    insts = tcldis.getinsts(bc)
+    stream = tcldis.InstStream(bc)
+    self.assertEqual(len(stream), len(insts))
+    self.assertEqual(stream.insts(), insts)
+    for i, (ref, inst) in enumerate(zip(stream, insts)):
+        self.assertEqual(stream.index(inst.loc), i)
+        self.assertEqual(
+            (ref.loc, ref.name, ref.ops, ref.targetloc),
+            tuple(inst)
+        )
+    # The C decoder agrees with the Python one, and on where blocks start
+    locs, opcodes, opslots, targetlocs = tcldis._decode_py(bc)
+    self.assertEqual((stream.locs, stream.opcodes), (locs, opcodes))
+    self.assertEqual(stream.opslots[:len(opslots)], opslots)
+    self.assertEqual(stream.targetlocs, targetlocs)
+    bblocks = tcldis._bblock_create(insts, stream.blockstarts)
+    self.assertEqual(
+        [bblock.insts for bblock in bblocks],
+        [bblock.insts for bblock in tcldis._bblock_create(insts)]
+    )
+
+def checkDecompileTo(self, bc):
+    out = io.StringIO()
+    tcldis.decompile_to(bc, out)
+    self.assertEqual(out.getvalue(), tcldis.decompile(bc))
+    lines = list(tcldis.iter_decompile_lines(bc))
+    self.assertTrue(all([line.endswith(u'\n') for line in lines]))
+
 # ----------
 
 class TestTclScript(unittest.TestCase):
-    def assertTclEqual(self, tcl):
-        self.assertEqual(tcl, tcldis.decompile(tcldis.getbc(tcl)))
-    def assertDecompileStepStructure(self, tcl):
-        steps, changes = tcldis.decompile_steps(tcldis.getbc(tcl))
+    def assertTclEqual(self, tcl, engine='step'):
+        self.assertEqual(tcl, tcldis.decompile(tcldis.getbc(tcl), engine))
+    def assertDecompileToEqual(self, tcl):
+        checkDecompileTo(self, tcldis.getbc(tcl))
+    def assertDecompileStepStructure(self, tcl, engine='step'):
+        steps, changes = tcldis.decompile_steps(tcldis.getbc(tcl), engine)
         checkDecompileStepStructure(self, steps, changes)
+        checkStepDeltas(self, tcldis.getbc(tcl), engine)
+    def assertInstStreamEqual(self, tcl):
+        checkInstStream(self, tcldis.getbc(tcl))
+    def assertPickleEqual(self, tcl):
+        checkPickle(self, tcldis.getbc(tcl))
 
 class TestTclProc(unittest.TestCase):
-    def assertTclEqual(self, tcl):
+    def assertTclEqual(self, tcl, engine='step'):
         proctcl = 'proc p {} {\n' + tcl + '\n}'
         tclpy.eval(proctcl)
-        self.assertEqual(tcl, tcldis.decompile(tcldis.getbc(proc_name='p')))
-    def assertDecompileStepStructure(self, tcl):
+        self.assertEqual(tcl, tcldis.decompile(tcldis.getbc(proc_name='p'), engine))
+    def assertDecompileToEqual(self, tcl):
         proctcl = 'proc p {} {\n' + tcl + '\n}'
         tclpy.eval(proctcl)
-        steps, changes = tcldis.decompile_steps(tcldis.getbc(proc_name='p'))
+        checkDecompileTo(self, tcldis.getbc(proc_name='p'))
+    def assertDecompileStepStructure(self, tcl, engine='step'):
+        proctcl = 'proc p {} {\n' + tcl + '\n}'
+        tclpy.eval(proctcl)
+        steps, changes = tcldis.decompile_steps(tcldis.getbc(proc_name='p'), engine)
         checkDecompileStepStructure(self, steps, changes)
+        checkStepDeltas(self, tcldis.getbc(proc_name='p'), engine)
+    def assertInstStreamEqual(self, tcl):
+        proctcl = 'proc p {} {\n' + tcl + '\n}'
+        tclpy.eval(proctcl)
+        checkInstStream(self, tcldis.getbc(proc_name='p'))
+    def assertPickleEqual(self, tcl):
+        proctcl = 'proc p {} {\n' + tcl + '\n}'
+        tclpy.eval(proctcl)
+        checkPickle(self, tcldis.getbc(proc_name='p'))
+
+class TestGetbcBatch(unittest.TestCase):
+    def setUp(self):
+        tclpy.eval(dedent('''\
+            namespace eval batchns {
+                proc p1 {} { puts a }
+                namespace eval inner {
+                    proc p2 {x} { return $x }
+                }
+            }
+            proc batchp {} { set x 1 }
+        '''))
+    def assertBCEqual(self, bc1, bc2):
+        self.assertEqual(repr(bc1), repr(bc2))
+    def test_getbc_many(self):
+        names = ['::batchns::p1', 'batchp', '::batchns::inner::p2']
+        bcs = tcldis.getbc_many(names)
+        self.assertEqual(len(bcs), len(names))
+        for name, bc in zip(names, bcs):
+            self.assertBCEqual(bc, tcldis.getbc(proc_name=name))
+        self.assertRaises(RuntimeError, tcldis.getbc_many, ['batchp', 'nonexistent'])
+    def test_getbc_many_unicode(self):
+        tclpy.eval(u'proc batch\u00e9 {} { puts b }'.encode('utf-8'))
+        bc, = tcldis.getbc_many([u'batch\u00e9'])
+        self.assertEqual(tcldis.decompile(bc), u'puts b\n')
+        bc, = tcldis.getbc_many([u'batch\u00e9'.encode('utf-8')])
+        self.assertEqual(tcldis.decompile(bc), u'puts b\n')
+    def test_getbc_namespace(self):
+        bcs = tcldis.getbc_namespace('::batchns')
+        self.assertEqual(
+            sorted(bcs.keys()), ['::batchns::inner::p2', '::batchns::p1']
+        )
+        for name, bc in bcs.items():
+            self.assertBCEqual(bc, tcldis.getbc(proc_name=name))
+        bcs = tcldis.getbc_namespace('::batchns', recursive=False)
+        self.assertEqual(bcs.keys(), ['::batchns::p1'])
+        self.assertIn('::batchp', tcldis.getbc_namespace())
+    def test_decompile_all(self):
+        expected = dict([
+            (name, tcldis.decompile(tcldis.getbc(proc_name=name)))
+            for name in ['::batchns::p1', '::batchns::inner::p2']
+        ])
+        self.assertEqual(tcldis.decompile_all('::batchns::*', workers=1), expected)
+        self.assertEqual(tcldis.decompile_all('::batchns::*', workers=2), expected)
+        self.assertEqual(
+            sorted(tcldis.decompile_all('::batchns::p*', workers=1).keys()),
+            ['::batchns::p1']
+        )
+    def test_decompile_all_pattern(self):
+        self.assertEqual(
+            tcldis.decompile_all('::batchns::p*', workers=1).keys(),
+            ['::batchns::p1']
+        )
+        # Procs that don't match aren't compiled
+        self.assertTrue(tcldis.getbc(proc_name='::batchns::inner::p2').compiled)
+        self.assertFalse(tcldis.getbc(proc_name='::batchns::p1').compiled)
+        # Tcl's string match, not fnmatch
+        self.assertEqual(
+            tcldis.decompile_all('::batchns::p[!1]', workers=1).keys(),
+            ['::batchns::p1']
+        )
+        self.assertEqual(
+            tcldis.decompile_all('::batchns::\\p1', workers=1).keys(),
+            ['::batchns::p1']
+        )
+        self.assertEqual(tcldis.decompile_all('::batch\\*', workers=1), {})
+        self.assertEqual(
+            sorted(tcldis.getbc_namespace(pattern=u'::*p?').keys()),
+            ['::batchns::inner::p2', '::batchns::p1']
+        )
+
+class TestGetbcReuse(unittest.TestCase):
+    def test_reuse(self):
+        tclpy.eval('proc reusep {} { puts a }')
+        self.assertTrue(tcldis.getbc(proc_name='reusep').compiled)
+        self.assertFalse(tcldis.getbc(proc_name='reusep').compiled)
+        tclpy.eval('reusep')
+        self.assertFalse(tcldis.getbc_many(['reusep'])[0].compiled)
+        # Redefining gives a new body that needs compiling
+        tclpy.eval('proc reusep {} { puts b }')
+        bc = tcldis.getbc(proc_name='reusep')
+        self.assertTrue(bc.compiled)
+        self.assertEqual(tcldis.decompile(bc), u'puts b\n')
+        self.assertTrue(tcldis.getbc(u'puts a').compiled)
+
+class TestBytecodeBuffer(unittest.TestCase):
+    def tearDown(self):
+        tcldis.bytecode_buffer(False)
+    def test_buffer(self):
+        tclpy.eval('proc bufp {x} { if {$x} { puts a } }')
+        bc = tcldis.getbc(proc_name='bufp')
+        codebc = tcldis.getbc(u'set x 1')
+        tcldis.bytecode_buffer()
+        bufbc = tcldis.getbc(proc_name='bufp')
+        buf = bufbc._bytecode
+        self.assertIsInstance(buf, tcldis._tcldis.BytecodeBuffer)
+        self.assertTrue(memoryview(buf).readonly)
+        self.assertEqual(bytearray(buf), bc._bytecode)
+        self.assertEqual(buf[0], bc._bytecode[0])
+        self.assertEqual(bufbc.digest(), bc.digest())
+        self.assertEqual(tcldis.decompile(bufbc), tcldis.decompile(bc))
+        self.assertEqual(pickle.loads(pickle.dumps(buf)), bc._bytecode)
+        # The bytecode outlives the proc it came from
+        tclpy.eval('proc bufp {} {}')
+        self.assertEqual(bytearray(buf), bc._bytecode)
+        # Or the temporary object compiled from code
+        buf = tcldis.getbc(u'set x 1').view()
+        self.assertEqual(buf.tobytes(), str(codebc._bytecode))
 
+class TestThreads(unittest.TestCase):
+    def test_getbc_threads(self):
+        tcls = [tcl for _, tcl in cases]
+        expected = [repr(tcldis.getbc(tcl)) for tcl in tcls]
+        errors = []
+        def getbcs():
+            try:
+                for _ in range(20):
+                    for tcl, bcrepr in zip(tcls, expected):
+                        self.assertEqual(repr(tcldis.getbc(tcl)), bcrepr)
+                # Each thread has its own interpreter
+                self.assertRaises(RuntimeError, tcldis.getbc, proc_name='p')
+                tcldis.release_thread_interp()
+                # and gets a new one if it calls in again
+                self.assertEqual(repr(tcldis.getbc(tcls[0])), expected[0])
+                tcldis.release_thread_interp()
+            except Exception as e:
+                errors.append(e)
+        tclpy.eval('proc p {} {}')
+        threads = [threading.Thread(target=getbcs) for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        # The importing thread keeps its interpreter
+        tcldis.release_thread_interp()
+        tcldis.getbc(proc_name='p')
+
+# Counts how many instructions are copied out by slicing
+class SliceCountList(list):
+    def __init__(self, *args):
+        super(SliceCountList, self).__init__(*args)
+        self.sliced = 0
+    def __getslice__(self, i, j):
+        ret = super(SliceCountList, self).__getslice__(i, j)
+        self.sliced += len(ret)
+        return ret
+    def __getitem__(self, i):
+        ret = super(SliceCountList, self).__getitem__(i)
+        if isinstance(i, slice):
+            self.sliced += len(ret)
+        return ret
+
+class TestBBlockCreate(unittest.TestCase):
+    def getbranchinsts(self, n):
+        branch = 'if {$a} {\n\tputs a\n} else {\n\tputs b\n}\n'
+        tclpy.eval('proc p {} {\n' + branch * n + '\n}')
+        return SliceCountList(tcldis.getinsts(tcldis.getbc(proc_name='p')))
+    def test_branches_linear(self):
+        for n in [1, 1000]:
+            insts = self.getbranchinsts(n)
+            bblocks = tcldis._bblock_create(insts)
+            # Condition, if and else blocks for each branch, then the end
+            self.assertEqual(len(bblocks), 3 * n + 1)
+            self.assertEqual(
+                [inst for bblock in bblocks for inst in bblock.insts],
+                insts
+            )
+            # Each instruction is copied into its block once, rather than
+            # repeatedly splitting what's left
+            self.assertEqual(insts.sliced, len(insts))
+
+class TestInstSeq(unittest.TestCase):
+    def test_splice(self):
+        rand = random.Random(0)
+        ref = range(1000)
+        seq = tcldis.InstSeq(ref)
+        snapshots = []
+        for n in range(200):
+            i = rand.randint(-len(ref), len(ref))
+            j = rand.randint(-len(ref), len(ref))
+            items = [object() for _ in range(rand.choice([0, 1, 2, 100]))]
+            snapshots.append((seq, list(ref)))
+            seq = seq.splice(i, j, items)
+            ref[i:j] = items
+            self.assertEqual(len(seq), len(ref))
+            self.assertEqual(list(seq), ref)
+            self.assertEqual(list(seq[i:j]), ref[i:j])
+            self.assertEqual(list(seq + seq), ref + ref)
+            if ref:
+                self.assertIs(seq[-1], ref[-1])
+        # Earlier versions are unaffected by later splices
+        for seq, ref in snapshots:
+            self.assertEqual(list(seq), ref)
+    def test_tuple(self):
+        ref = tuple(range(1000))
+        seq = tcldis.InstSeq(ref)
+        self.assertEqual(seq, ref)
+        self.assertEqual(ref, seq)
+        self.assertEqual(seq, tcldis.InstSeq(list(ref)))
+        self.assertNotEqual(seq, ref[:-1])
+        self.assertNotEqual(seq, list(ref))
+        self.assertFalse(seq != ref)
+        self.assertEqual(hash(seq), hash(ref))
+        self.assertEqual(seq.index(500), 500)
+        self.assertEqual((seq + seq).count(1), 2)
+        self.assertRaises(ValueError, seq.index, -1)
+
+class TestFmt(unittest.TestCase):
+    def test_literal_quoting(self):
+        lit = lambda v: tcldis.BCLiteral(None, v).fmt()
+        self.assertEqual(lit(u''), u'{}')
+        self.assertEqual(lit(u'abc'), u'abc')
+        self.assertEqual(lit(u'a b\nc'), u'{a b\nc}')
+        self.assertEqual(lit(u'a}b'), u'"a\\}b"')
+        self.assertEqual(lit(u'"a\rb"'), u'"\\"a\\rb\\""')
+    def test_reuse(self):
+        arg = tcldis.BCLiteral(None, u'a b')
+        self.assertEqual(arg.fmt(), u'{a b}')
+        # Rendering the parent must use the text already kept for the child
+        arg.write = None
+        call = tcldis.BCProcCall(None, [tcldis.BCLiteral(None, u'puts'), arg])
+        self.assertEqual(call.fmt(), u'[puts {a b}]')
+    def test_writeinst(self):
+        call = tcldis.BCProcCall(
+            None, [tcldis.BCLiteral(None, u'puts'), tcldis.BCLiteral(None, u'a')]
+        )
+        bblock = tcldis.BBlock([call], 0)
+        out = tcldis.Writer()
+        bblock.writeinst(out, call)
+        self.assertEqual(out.getvalue(), u'\u00bb [puts a]')
+        # Only steps keep the text of each instruction
+        self.assertFalse(hasattr(call, '_fmtcache'))
+        self.assertEqual(bblock.fmt_insts(), [u'\u00bb [puts a]'])
+        self.assertEqual(call._fmtcache, u'[puts a]')
+
+class TestLiterals(unittest.TestCase):
+    def tearDown(self):
+        tcldis.literal_intern(False)
+    def test_unicode(self):
+        bc = tcldis.getbc(u'set x \u00e9t\u00e9\n'.encode('utf-8'))
+        self.assertEqual(bc._literals, [u'x', u'\u00e9t\u00e9'])
+        self.assertTrue(all(type(l) is unicode for l in bc._literals))
+    def test_intern(self):
+        tcldis.literal_intern()
+        bc1 = tcldis.getbc(u'set longvarname 1\n')
+        bc2 = tcldis.getbc(u'set longvarname 2\n')
+        self.assertIs(bc1._literals[0], bc2._literals[0])
+        tcldis.literal_intern(False)
+        bc3 = tcldis.getbc(u'set longvarname 3\n')
+        self.assertEqual(bc1._literals[0], bc3._literals[0])
+        self.assertIsNot(bc1._literals[0], bc3._literals[0])
+
+class TestDump(unittest.TestCase):
+    def getbcs(self):
+        bcs = []
+        for _, tcl in cases:
+            bcs.append(tcldis.getbc(tcl))
+            tclpy.eval('proc p {} {\n%s\n}' % (tcl,))
+            bcs.append(tcldis.getbc(proc_name='p'))
+        return bcs
+    def test_roundtrip(self):
+        bcs = self.getbcs()
+        f = io.BytesIO()
+        for bc in bcs:
+            bc.dump(f)
+        f.seek(0)
+        for bc in bcs:
+            loaded = tcldis.BC.load(f)
+            self.assertEqual(repr(loaded), repr(bc))
+            self.assertEqual(loaded.compiled, bc.compiled)
+            self.assertEqual(loaded.digest(), bc.digest())
+        self.assertRaises(EOFError, tcldis.BC.load, f)
+    def test_bad(self):
+        f = io.BytesIO()
+        tcldis.getbc(u'set x 1').dump(f)
+        data = f.getvalue()
+        for bad in [
+                data[:-1], 'X' + data[1:], data.replace('push1', 'push9'),
+                # Not False, True or None
+                data[:-1] + '\x07']:
+            self.assertRaises(ValueError, tcldis.BC.load, io.BytesIO(bad))
+    def test_copy(self):
+        bc = tcldis.getbc(u'set x 1')
+        bc.skip(2)
+        for compiled in [False, True, None]:
+            bc.compiled = compiled
+            copy = bc.copy()
+            self.assertEqual(copy.compiled, compiled)
+            self.assertEqual(copy.pc(), 2)
+    def test_offline(self):
+        # Decompile in a process that can't import _tcldis
+        bcs = self.getbcs()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'bcs')
+            with open(path, 'wb') as f:
+                for bc in bcs:
+                    bc.dump(f)
+            script = dedent("""
+                import sys
+                sys.modules['_tcldis'] = None
+                import tcldis
+                with open(sys.argv[1], 'rb') as f:
+                    while True:
+                        try:
+                            bc = tcldis.BC.load(f)
+                        except EOFError:
+                            break
+                        try:
+                            out = tcldis.decompile(bc)
+                        except Exception as e:
+                            out = type(e).__name__
+                        sys.stdout.write(out.encode('utf-8') + '\\0')
+            """)
+            out = subprocess.check_output([sys.executable, '-c', script, path])
+        finally:
+            shutil.rmtree(tmpdir)
+        expected = []
+        for bc in bcs:
+            try:
+                expected.append(tcldis.decompile(bc))
+            except Exception as e:
+                expected.append(type(e).__name__)
+        self.assertEqual(out.decode('utf-8').split(u'\0')[:-1], expected)
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'archive')
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def test_archive(self):
+        bcs = {}
+        for name, tcl in cases:
+            bcs['::script::' + name] = tcldis.getbc(tcl)
+            tclpy.eval('proc p {} {\n%s\n}' % (tcl,))
+            bcs['::proc::' + name] = tcldis.getbc(proc_name='p')
+        # Same content under another name
+        bcs['::copy'] = tcldis.getbc(cases[0][1])
+        tcldis.write_archive(self.path, bcs)
+        with tcldis.BCArchive(self.path) as archive:
+            self.assertEqual(len(archive), len(bcs))
+            self.assertEqual(archive.keys(), sorted(bcs))
+            for name, bc in bcs.iteritems():
+                self.assertIn(name, archive)
+                self.assertEqual(repr(archive[name]), repr(bc))
+                self.assertEqual(archive[name].compiled, bc.compiled)
+                self.assertEqual(repr(archive.bydigest(bc.digest())), repr(bc))
+            self.assertNotIn('::missing', archive)
+            self.assertRaises(KeyError, lambda: archive['::missing'])
+            self.assertRaises(KeyError, archive.bydigest, '0' * 40)
+            self.assertEqual(
+                tcldis.decompile(archive[u'::proc::set']),
+                tcldis.decompile(bcs['::proc::set'])
+            )
+            # Literals are pooled
+            lit15 = lambda bc: bc._literals[bc._literals.index(u'15')]
+            self.assertIs(
+                lit15(archive['::script::set']), lit15(archive['::proc::set'])
+            )
+    def test_bad(self):
+        with open(self.path, 'wb') as f:
+            f.write('X' * 100)
+        self.assertRaises(ValueError, tcldis.BCArchive, self.path)
+        with tcldis.BCArchiveWriter(self.path) as writer:
+            writer.add('a', tcldis.getbc(u'set x 1'))
+            self.assertRaises(ValueError, writer.add, 'a', tcldis.getbc(u'set x 2'))
+        self.assertEqual(tcldis.BCArchive(self.path).keys(), ['a'])
+        # Corrupt the compiled flag of the first record, after its bytecode
+        # and pc
+        bc = tcldis.getbc(u'set x 1')
+        pos = tcldis._AR_HEADER.size + 4 + len(bc._bytecode) + 4
+        with open(self.path, 'r+b') as f:
+            f.seek(pos)
+            f.write('\x07')
+        archive = tcldis.BCArchive(self.path)
+        self.assertRaises(ValueError, archive.__getitem__, 'a')
+        archive.close()
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = tcldis.enable_cache(maxentries=2)
+    def tearDown(self):
+        tcldis.disable_cache()
+    def test_hit(self):
+        # Same bytecode from different source
+        bc1 = tcldis.getbc(u'set x 15\n')
+        bc2 = tcldis.getbc(u'set   x   15\n')
+        self.assertEqual(bc1.digest(), bc2.digest())
+        self.assertEqual(tcldis.decompile(bc1), tcldis.decompile(bc2))
+        self.assertEqual(tcldis.cache_stats()['hits'], 1)
+        self.assertEqual(tcldis.cache_stats()['misses'], 1)
+        steps, changes = tcldis.decompile_steps(bc1)
+        steps[0].pop()
+        self.assertNotEqual(tcldis.decompile_steps(bc2)[0], steps)
+        self.assertEqual(tcldis.cache_stats()['hits'], 2)
+    def test_skipped(self):
+        bc = tcldis.getbc(u'set x 1\nputs a\n')
+        self.assertEqual(tcldis.decompile(bc), u'set x 1\nputs a\n')
+        bc.skip(5)
+        self.assertEqual(tcldis.decompile(bc), u'<5: pop ()>\nputs a\n')
+        self.assertEqual(tcldis.cache_stats()['hits'], 0)
+    def test_decompile_to(self):
+        bc = tcldis.getbc(u'set x 15\n')
+        out = io.StringIO()
+        tcldis.decompile_to(bc, out)
+        self.assertEqual(tcldis.decompile(bc), out.getvalue())
+        self.assertEqual(tcldis.cache_stats()['hits'], 1)
+        # Lines are always decompiled afresh
+        self.assertEqual(list(tcldis.iter_decompile_lines(bc)), [u'set x 15\n'])
+        self.assertEqual(tcldis.cache_stats()['hits'], 1)
+    def test_evict(self):
+        for tcl in [u'set x 1\n', u'set x 2\n', u'set x 3\n']:
+            tcldis.decompile(tcldis.getbc(tcl))
+        self.assertEqual(tcldis.cache_stats()['entries'], 2)
+        self.assertEqual(tcldis.cache_stats()['misses'], 3)
+        tcldis.decompile(tcldis.getbc(u'set x 1\n'))
+        self.assertEqual(tcldis.cache_stats()['misses'], 4)
+        tcldis.enable_cache(maxbytes=1)
+        tcldis.decompile(tcldis.getbc(u'set x 1\n'))
+        self.assertEqual(tcldis.cache_stats()['entries'], 0)
+    def test_disk(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'cache.db')
+            bc = tcldis.getbc(u'set x 15\n')
+            tcldis.enable_disk_cache(path)
+            tcl = tcldis.decompile(bc)
+            steps = tcldis.decompile_steps(bc)
+            self.assertEqual(tcldis.cache_stats()['misses'], 2)
+            # As if from a new process
+            tcldis.enable_disk_cache(path)
+            self.assertEqual(tcldis.decompile(bc), tcl)
+            self.assertEqual(tcldis.decompile_steps(bc), steps)
+            self.assertEqual(tcldis.cache_stats()['hits'], 2)
+            self.assertEqual(tcldis.cache_stats()['entries'], 2)
+            tcldis.decompile(bc, engine='stack')
+            tcldis.DiskCache(path).prune(maxbytes=0)
+            self.assertEqual(tcldis.cache_stats()['entries'], 0)
+        finally:
+            shutil.rmtree(tmpdir)
+    def test_disk_total(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            cache = tcldis.DiskCache(os.path.join(tmpdir, 'cache.db'))
+            cache.put(('a', 'step', 'digest', 0), u'x' * 100, 0)
+            nbytes = cache.stats()['bytes']
+            cache.put(('a', 'step', 'digest', 0), u'x' * 100, 0)
+            cache.put(('b', 'step', 'digest', 0), u'x' * 100, 0)
+            self.assertEqual(cache.stats()['entries'], 2)
+            self.assertEqual(cache.stats()['bytes'], 2 * nbytes)
+            # Only goes over on the third
+            cache.maxbytes = 3 * nbytes
+            cache.put(('c', 'step', 'digest', 0), u'x' * 100, 0)
+            self.assertEqual(cache.stats()['entries'], 3)
+            cache.put(('d', 'step', 'digest', 0), u'x' * 100, 0)
+            self.assertEqual(cache.stats()['entries'], 3)
+            self.assertEqual(cache.stats()['bytes'], 3 * nbytes)
+            self.assertTrue(('d', 'step', 'digest', 0) in cache)
+            self.assertFalse(('a', 'step', 'digest', 0) in cache)
+            cache.clear()
+            self.assertEqual(cache.stats()['bytes'], 0)
+            # Without Tcl, e.g. before any BC.load
+            patchlevel = tcldis.TCL_PATCH_LEVEL
+            tcldis.TCL_PATCH_LEVEL = None
+            try:
+                cache.put(('a', 'step', 'digest', 0), u'x', 0)
+                cache.put(('a', 'step', 'digest', 0), u'x', 0)
+                self.assertEqual(len(cache), 1)
+                self.assertEqual(cache.get(('a', 'step', 'digest', 0)), u'x')
+            finally:
+                tcldis.TCL_PATCH_LEVEL = patchlevel
+            cache.prune(stale=True)
+            self.assertEqual(len(cache), 0)
+            self.assertEqual(cache.stats()['bytes'], 0)
+        finally:
+            shutil.rmtree(tmpdir)
+    def test_disk_threads(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            tcldis.enable_disk_cache(os.path.join(tmpdir, 'cache.db'))
+            bc = tcldis.getbc(u'set x 15\n')
+            tcl = tcldis.decompile(bc)
+            results = []
+            def decompile():
+                results.append(tcldis.decompile(bc))
+            threads = [threading.Thread(target=decompile) for _ in range(4)]
+            for thread in threads: thread.start()
+            for thread in threads: thread.join()
+            self.assertEqual(results, [tcl] * 4)
+            self.assertEqual(tcldis.cache_stats()['hits'], 4)
+        finally:
+            shutil.rmtree(tmpdir)
 
 def setupcase(test_class, name, case):
     setattr(
@@ -182,6 +779,31 @@ def setupcase(test_class, name, case):
         'test_decompilesteps_' + name,
         lambda self: self.assertDecompileStepStructure(case)
     )
+    setattr(
+        test_class,
+        'test_decompile_stack_' + name,
+        lambda self: self.assertTclEqual(case, engine='stack')
+    )
+    setattr(
+        test_class,
+        'test_decompilesteps_stack_' + name,
+        lambda self: self.assertDecompileStepStructure(case, engine='stack')
+    )
+    setattr(
+        test_class,
+        'test_decompileto_' + name,
+        lambda self: self.assertDecompileToEqual(case)
+    )
+    setattr(
+        test_class,
+        'test_pickle_' + name,
+        lambda self: self.assertPickleEqual(case)
+    )
+    setattr(
+        test_class,
+        'test_inststream_' + name,
+        lambda self: self.assertInstStreamEqual(case)
+    )
 
 for name, case in cases:
     setupcase(TestTclScript, name, case)
@@ -406,6 +406,26 @@ var DecompileSteps = React.createClass({
     }
 });
 
+// The server only sends the lines which change in each step (see
+// tcldis.decompile_step_deltas), fill in the rest here
+function rebuildSteps(first, deltas) {
+    var steps = [first];
+    deltas.forEach(function (delta) {
+        var step = steps[steps.length-1].slice();
+        // Go backwards so earlier hunks' indexes are still valid
+        delta.slice().reverse().forEach(function (hunk) {
+            var bbfrom1 = hunk.from[0][0], lfrom1 = hunk.from[0][1];
+            var bbfrom2 = hunk.from[1][0], lfrom2 = hunk.from[1][1];
+            var lines = hunk.lines.slice();
+            lines[0] = step[bbfrom1].slice(0, lfrom1).concat(lines[0]);
+            lines[lines.length-1] = lines[lines.length-1].concat(step[bbfrom2].slice(lfrom2));
+            [].splice.apply(step, [bbfrom1, bbfrom2-bbfrom1+1].concat(lines));
+        });
+        steps.push(step);
+    });
+    return steps;
+}
+
 window.TclDisUI = React.createClass({
     getInitialState: function () {
         return {'steps': [], 'changes': []};
@@ -418,7 +438,10 @@ window.TclDisUI = React.createClass({
                 this.setState(this.getInitialState());
                 return;
             }
-            this.setState(data);
+            this.setState({
+                'steps': rebuildSteps(data.first, data.deltas),
+                'changes': data.changes
+            });
         }.bind(this));
     },
     render: function () {
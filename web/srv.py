@@ -25,8 +25,8 @@ def decompile_steps():
     tcl = request.json
     proctcl = 'proc p {} {\n' + tcl + '\n}'
     tclpy.eval(proctcl)
-    steps, changes = tcldis.decompile_steps(tcldis.getbc(proc_name='p'))
-    return json.dumps({'steps': steps, 'changes': changes})
+    first, deltas, changes = tcldis.decompile_step_deltas(tcldis.getbc(proc_name='p'))
+    return json.dumps({'first': first, 'deltas': deltas, 'changes': changes})
 
 def start():
     # Start the server